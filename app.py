@@ -1,23 +1,34 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, session
-from flask_session import Session
-from dotenv import load_dotenv
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 import msal
-from PIL import Image, ImageDraw, ImageFont
-import smtplib
+from dotenv import load_dotenv
 from email.message import EmailMessage
 import io
-import imaplib
+import time
+from concurrent import futures
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
+from imaging import FONT_PATH, normalize_template, render_cache, render_key, render_plain, render_with_template, template_cache, template_identity
+from rendering import ingest_service, render_service
+from jobs import job_queue, job_runner
+from mailer import Outbox, SMTPPool
+from leader import LeaderElection
+from auth import AUTH_REMEMBER_SECONDS, MSALClient, pack_user, token_cache_store, unpack_user
+from catalog import TEMPLATE_DIR, TEMPLATE_IDLE_SECONDS, TEMPLATE_SYNC_INTERVAL, template_catalog, template_store
+from inbox import InboxWatcher, UIDSync, body_parts, download_part
+from warmup import PREWARM_TEMPLATES, PREWARM_WINDOW_SECONDS, warmup
+from sessions import SESSION_EXPIRE_INTERVAL, SQLiteSessionInterface, session_store
+from models import decode_json, from_form, from_payload, to_payload
+import msgspec
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your_flask_secret_key')
-app.config['SESSION_TYPE'] = 'filesystem'
-Session(app)
+# Sessions live in SQLite; the cookie carries only the signed session id
+app.session_interface = SQLiteSessionInterface(session_store)
 
 # Azure AD configuration
 CLIENT_ID = os.getenv('CLIENT_ID')
@@ -32,29 +43,115 @@ EMAIL_USERNAME = os.getenv('EMAIL_USERNAME')
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
 MARKETING_EMAIL = os.getenv('MARKETING_EMAIL')
 
+# Authenticated SMTP sessions shared by every outbound email. A submission's job
+# stays in 'sending' until the outbox has delivered its email or given up on it.
+smtp_pool = SMTPPool(EMAIL_USERNAME, EMAIL_PASSWORD)
+outbox = Outbox(smtp_pool, on_delivered=job_queue.finish_handed_off, on_failed=job_queue.fail_handed_off)
+
 # IMAP configuration
 IMAP_SERVER = "outlook.office365.com"
 IMAP_PORT = 993
 
-# Scheduler setup
-scheduler = BackgroundScheduler()
-scheduler.start()
-
-# Shut down the scheduler when exiting the app
-atexit.register(lambda: scheduler.shutdown())
-
-def build_msal_app(cache=None, authority=None):
-    return msal.ConfidentialClientApplication(
-        CLIENT_ID, authority=authority or AUTHORITY,
-        client_credential=CLIENT_SECRET, token_cache=cache)
+# Scheduler setup; only the elected leader process starts it (see below).
+# A job never runs concurrently with itself, and missed runs are coalesced.
+scheduler = BackgroundScheduler(job_defaults={'max_instances': 1, 'coalesce': True})
+scheduler.add_job(session_store.expire, 'interval', seconds=SESSION_EXPIRE_INTERVAL)
+
+def sync_templates():
+    # Pick up templates copied into or deleted from the template directory by hand
+    added, removed = template_store.sync_if_changed()
+    if removed:
+        template_cache.drop_shared([os.path.join(TEMPLATE_DIR, name + '.jpg') for name in removed])
+    if added or removed:
+        template_catalog.invalidate()
+        print(f"Template directory changed: {len(added)} added, {len(removed)} removed.")
+
+def release_idle_templates():
+    # Free the shared decoded copies of templates nobody has rendered lately
+    idle = template_store.unused_since(time.time() - TEMPLATE_IDLE_SECONDS)
+    dropped = template_cache.drop_shared([os.path.join(TEMPLATE_DIR, name + '.jpg') for name in idle])
+    if dropped:
+        print(f"Released {dropped} decoded templates unused for {TEMPLATE_IDLE_SECONDS / 86400:g} days.")
+
+scheduler.add_job(sync_templates, 'interval', seconds=TEMPLATE_SYNC_INTERVAL)
+scheduler.add_job(release_idle_templates, 'interval', hours=1)
+
+# Warm up in the background so the first requests are not slow: start the render workers
+# with the fonts loaded and the most used templates decoded, and compile the form
+def warm_renderers(timeout):
+    since = time.time() - PREWARM_WINDOW_SECONDS
+    template_paths = [os.path.join(TEMPLATE_DIR, name + '.jpg')
+                      for name in template_store.most_used(PREWARM_TEMPLATES, since)]
+    futures.wait(render_service.warm(template_paths), timeout)
+
+def warm_form(timeout):
+    app.jinja_env.get_template('index.html')
+
+warmup.add(warm_renderers)
+warmup.add(warm_form)
+warmup.start()
+atexit.register(lambda: render_service.shutdown())
+atexit.register(lambda: ingest_service.shutdown())
+atexit.register(lambda: smtp_pool.close())
+
+# One MSAL application per process, with pooled connections and cached authority metadata
+msal_client = MSALClient(CLIENT_ID, CLIENT_SECRET, AUTHORITY)
+
+# Signed cookie naming the account whose token cache is kept server side, so an
+# expired session can be renewed with acquire_token_silent instead of a redirect
+REMEMBER_COOKIE = 'account'
+remember = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='remembered-account')
+
+def sign_in(claims):
+    # Keeps only the claims the application uses, packed by pack_user(), in the
+    # session; returns False for users outside the company domain
+    if not claims.get('preferred_username', '').endswith('@jacksonhogg.com'):
+        return False
+    session['user'] = pack_user(claims)
+    return True
+
+def current_user():
+    # The signed-in SessionUser, or None once the sign-in has expired
+    return unpack_user(session.get('user'))
+
+def silent_login():
+    cookie = request.cookies.get(REMEMBER_COOKIE)
+    if not cookie:
+        return False
+    try:
+        account_id = remember.loads(cookie, max_age=AUTH_REMEMBER_SECONDS)
+    except BadSignature:
+        return False
+    try:
+        cache = token_cache_store.load(account_id)
+        if cache is None:
+            return False
+        msal_app = msal_client.with_token_cache(cache)
+        account = next((a for a in msal_app.get_accounts() if a['home_account_id'] == account_id), None)
+        if account is None:
+            return False
+        result = msal_app.acquire_token_silent(SCOPE, account=account)
+        if not result or 'error' in result:
+            return False
+        token_cache_store.save(account_id, cache)
+        claims = result.get('id_token_claims') or {
+            'preferred_username': account.get('username', ''),
+            'oid': account.get('local_account_id'),
+            'tid': account.get('realm'),
+        }
+        return sign_in(claims)
+    except Exception as e:
+        # Fall back to the interactive sign-in
+        print(f"Error during silent sign-in: {e}")
+        return False
 
 def build_auth_url():
-    return build_msal_app().get_authorization_request_url(
+    return msal_client.get().get_authorization_request_url(
         SCOPE, redirect_uri=url_for('authorized', _external=True))
 
 @app.route('/')
 def index():
-    if not session.get('user'):
+    if current_user() is None and not silent_login():
         return redirect(url_for('login'))
     return redirect(url_for('form'))
 
@@ -68,172 +165,182 @@ def authorized():
     if request.args.get('error'):
         return f"Login error: {request.args['error']}"
     if 'code' in request.args:
-        result = build_msal_app().acquire_token_by_authorization_code(
+        cache = msal.SerializableTokenCache()
+        msal_app = msal_client.with_token_cache(cache)
+        result = msal_app.acquire_token_by_authorization_code(
             request.args['code'],
             scopes=SCOPE,
             redirect_uri=url_for('authorized', _external=True))
         if "error" in result:
             return f"Token acquisition error: {result['error']}"
-        session['user'] = result.get('id_token_claims')
-        email_address = session['user'].get('preferred_username', '')
-        if not email_address.endswith('@jacksonhogg.com'):
+        try:
+            allowed = sign_in(result.get('id_token_claims') or {})
+        except ValueError as e:
+            return f"Sign-in error: {e}"
+        if not allowed:
             session.clear()
             return "Access denied: Unauthorized email domain."
+        # Keep the tokens so the next expired session can be renewed silently
+        response = redirect(url_for('form'))
+        accounts = msal_app.get_accounts()
+        if not accounts:
+            return response
+        account_id = accounts[0]['home_account_id']
+        token_cache_store.save(account_id, cache)
+        response.set_cookie(REMEMBER_COOKIE, remember.dumps(account_id), max_age=AUTH_REMEMBER_SECONDS,
+                            secure=request.is_secure, httponly=True, samesite='Lax')
+        return response
     return redirect(url_for('form'))
 
 @app.route('/logout')
 def logout():
     session.clear()
-    return redirect('https://login.microsoftonline.com/common/oauth2/v2.0/logout' +
-                    f'?post_logout_redirect_uri={url_for("index", _external=True)}')
+    cookie = request.cookies.get(REMEMBER_COOKIE)
+    if cookie:
+        try:
+            token_cache_store.delete(remember.loads(cookie))
+        except BadSignature:
+            pass
+    response = redirect('https://login.microsoftonline.com/common/oauth2/v2.0/logout' +
+                        f'?post_logout_redirect_uri={url_for("index", _external=True)}')
+    response.delete_cookie(REMEMBER_COOKIE)
+    return response
 
 @app.route('/form', methods=['GET', 'POST'])
 def form():
-    if not session.get('user'):
-        return redirect(url_for('login'))
+    user = current_user()
+    if user is None:
+        if not silent_login():
+            return redirect(url_for('login'))
+        user = current_user()
 
     if request.method == 'POST':
-        wants_branded_ad = request.form.get('wants_branded_ad') == 'yes'
-        if wants_branded_ad:
-            selected_template = request.form.get('template_selection')
-            if selected_template == 'New Brand':
-                # Send details to marketing team
-                send_email_to_marketing(request.form.to_dict())
-                return "Your request for a new branded ad has been submitted. The marketing team has been informed and will design a new branded ad for you."
-            else:
-                # Use selected template to generate image
-                template_path = os.path.join('static', 'BrandedAds', selected_template + '.jpg')
-                image = generate_image_with_template(request.form.to_dict(), template_path)
-                send_email(request.form.get('email'), request.form.get('job_title'), image, request.form.to_dict())
-                return "Email with your branded ad has been sent successfully!"
-        else:
-            # Regular image generation
-            image = generate_image(request.form.to_dict())
-            send_email(request.form.get('email'), request.form.get('job_title'), image, request.form.to_dict())
-            return "Email sent successfully!"
+        try:
+            post = from_form(request.form)
+        except msgspec.ValidationError as e:
+            return f"Invalid submission: {e}", 400
+        if not template_exists(post):
+            return f"Invalid submission: unknown template '{post.template_selection}'", 400
+        job_id = job_runner.submit('submission', data=to_payload(post), link=form_link(post))
+        status_url = url_for('job_status', job_id=job_id)
+        if post.new_brand:
+            return f"Your request for a new branded ad has been submitted. The marketing team will be informed and will design a new branded ad for you. (Job {job_id})", 202, {'Location': status_url}
+        return f"Your job post has been accepted and the email with your image will be sent shortly. (Job {job_id})", 202, {'Location': status_url}
 
     # Pre-fill data if available
     data = request.args.to_dict()
-    email_address = session['user'].get('preferred_username', '')
-    data.setdefault('email', email_address)
+    data.setdefault('email', user.username)
     
-    # Get list of templates with display names
-    templates = sorted([
-        {
-            'filename': f[:-4],
-            'display_name': f[:-4].replace("_", " ")
-        }
-        for f in os.listdir(os.path.join('static', 'BrandedAds')) if f.endswith('.jpg')
-    ], key=lambda x: x['display_name'])
-    
-    return render_template('index.html', data=data, templates=templates)
+    # Templates are looked up as the user types, see search_templates()
+    return render_template('index.html', data=data)
+
+@app.route('/templates/search')
+def search_templates():
+    if current_user() is None and not silent_login():
+        return jsonify({'error': 'Not signed in'}), 401
+    query = request.args.get('q', '')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', 20, type=int)
+    total, results = template_catalog.search(query, offset, limit)
+    next_offset = offset + len(results)
+    return jsonify({
+        'query': query,
+        'total': total,
+        'results': results,
+        'next_offset': next_offset if next_offset < total else None,
+    })
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    data = request.json
-    wants_branded_ad = data.get('wants_branded_ad', False)
-    if wants_branded_ad:
-        selected_template = data.get('template_selection')
-        if selected_template == 'New Brand':
-            # Send details to marketing team
-            send_email_to_marketing(data)
-            return 'New brand request submitted', 200
-        else:
-            # Use selected template to generate image
-            template_path = os.path.join('static', 'BrandedAds', selected_template + '.jpg')
-            image = generate_image_with_template(data, template_path)
-            send_email(data.get('email'), data.get('job_title'), image, data)
-            return 'Branded ad email sent', 200
+    try:
+        post = decode_json(request.get_data())
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        return jsonify({'error': str(e)}), 400
+    if not template_exists(post):
+        return jsonify({'error': f"Unknown template '{post.template_selection}'"}), 400
+    job_id = job_runner.submit('submission', data=to_payload(post), link=form_link(post))
+    status_url = url_for('job_status', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status_url': status_url}), 202, {'Location': status_url}
+
+@app.before_request
+def warm_forked_worker():
+    # No-op once this process has warmed up; a worker forked after start-up warms up here
+    warmup.start()
+
+@app.route('/ready')
+def ready():
+    status = warmup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({'outbox': outbox.stats(), 'smtp': smtp_pool.stats(),
+                    'fonts': render_service.stats(), 'render_cache': render_cache.stats()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+def template_exists(post):
+    # A branded ad must name a template the store knows, or ask for a new one
+    return not post.wants_branded_ad or post.new_brand or template_store.get(post.template_selection) is not None
+
+def form_link(post):
+    # Pre-filled form link for the email, built while the request context is available
+    return url_for('form', _external=True, **post.form_fields())
+
+def process_submission(job, data, link):
+    post = from_payload(data)
+    if post.new_brand:
+        # Send details to marketing team
+        job.set_status('sending')
+        send_email_to_marketing(post, job.id)
+        job.hand_off()
+        return
+
+    job.set_status('rendering')
+    if post.wants_branded_ad:
+        # Use selected template to generate image
+        template_path = os.path.join(TEMPLATE_DIR, post.template_selection + '.jpg')
+        image = generate_image_with_template(post, template_path)
+        template_store.record_use(post.template_selection)
     else:
         # Regular image generation
-        image = generate_image(data)
-        send_email(data.get('email'), data.get('job_title'), image, data)
-        return 'Email sent successfully', 200
-
-def generate_image(data):
-    # Create a blank image
-    img = Image.new('RGB', (1080, 1080), color='white')
-    draw = ImageDraw.Draw(img)
-
-    # Load font
-    font_path = os.path.join('static', 'fonts', 'PTSans-Regular.ttf')
-    font_size = 100  # Starting font size
-    font = ImageFont.truetype(font_path, font_size)
-
-    # Define text and bounding box
-    text = f"{data.get('job_title', '')}\n{data.get('job_location', '')}\n{data.get('job_salary', '')}"
-    max_width = 1000
-    max_height = 1000
-
-    # Adjust font size to fit within bounding box
-    while True:
-        w, h = draw.multiline_textsize(text, font=font)
-        if w <= max_width and h <= max_height:
-            break
-        font_size -= 1
-        if font_size < 10:
-            break  # Prevent font size from becoming too small
-        font = ImageFont.truetype(font_path, font_size)
-
-    # Calculate position
-    x = (1080 - w) / 2
-    y = (1080 - h) / 2
-
-    # Draw text
-    draw.multiline_text((x, y), text, fill='black', font=font, align='center')
-
-    # Save image to a BytesIO object
-    img_bytes = io.BytesIO()
-    img.save(img_bytes, format='JPEG', dpi=(300, 300))
-    img_bytes.seek(0)
-    return img_bytes
-
-def generate_image_with_template(data, template_path):
-    # Open the template image
-    img = Image.open(template_path).convert('RGB')
-    draw = ImageDraw.Draw(img)
-
-    # Load font
-    font_path = os.path.join('static', 'fonts', 'PTSans-Regular.ttf')
-    font_size = 50  # Starting font size
-    font = ImageFont.truetype(font_path, font_size)
-
-    # Define text and bounding box
-    text = f"{data.get('job_title', '')}\n{data.get('job_location', '')}\n{data.get('job_salary', '')}"
-    max_width = img.width - 100
-    max_height = img.height - 100
-
-    # Adjust font size to fit within bounding box
-    while True:
-        w, h = draw.multiline_textsize(text, font=font)
-        if w <= max_width and h <= max_height:
-            break
-        font_size -= 1
-        if font_size < 10:
-            break  # Prevent font size from becoming too small
-        font = ImageFont.truetype(font_path, font_size)
-
-    # Calculate position
-    x = (img.width - w) / 2
-    y = (img.height - h) / 2
-
-    # Draw text
-    draw.multiline_text((x, y), text, fill='black', font=font, align='center')
-
-    # Save image to a BytesIO object
-    img_bytes = io.BytesIO()
-    img.save(img_bytes, format='JPEG', dpi=(300, 300))
-    img_bytes.seek(0)
-    return img_bytes
-
-def send_email(to_email, job_title, image_bytes, form_data):
+        image = generate_image(post)
+
+    job.set_status('sending')
+    send_email(post, image, link, job.id)
+    # Finished by the outbox once the email has been delivered
+    job.hand_off()
+
+def generate_image(post):
+    # Reuse an identical earlier render without touching Pillow
+    cache_key = render_key('plain', post, size=1080, max_font_size=100, box=1000, dpi=300, font=FONT_PATH)
+    image = render_cache.get(cache_key)
+    if image is None:
+        # Draw and encode in the render pool instead of the request thread
+        image = render_service.render(render_plain, post)
+        render_cache.put(cache_key, image)
+    return io.BytesIO(image)
+
+def generate_image_with_template(post, template_path):
+    # Reuse an identical earlier render without touching Pillow
+    cache_key = render_key(template_identity(template_path), post, max_font_size=50, margin=100, dpi=300, font=FONT_PATH)
+    image = render_cache.get(cache_key)
+    if image is None:
+        # Decode, draw and encode in the render pool instead of the request thread
+        image = render_service.render(render_with_template, post, template_path)
+        render_cache.put(cache_key, image)
+    return io.BytesIO(image)
+
+def send_email(post, image_bytes, link, job_id=None):
     msg = EmailMessage()
-    msg['Subject'] = f"LinkedIn Post: {job_title}"
+    msg['Subject'] = f"LinkedIn Post: {post.job_title}"
     msg['From'] = EMAIL_USERNAME
-    msg['To'] = to_email
-
-    # Construct the pre-filled form link with query parameters
-    link = url_for('form', _external=True, **form_data)
+    msg['To'] = post.email
 
     # Email content with the pre-filled form link
     msg.set_content(f'This is an auto-generated image. If you\'d like to make any changes, please [click here]({link}).')
@@ -241,91 +348,111 @@ def send_email(to_email, job_title, image_bytes, form_data):
     # Add the image as an attachment
     msg.add_attachment(image_bytes.read(), maintype='image', subtype='jpeg', filename='job_post.jpeg')
 
-    # Send email using Office 365 SMTP
-    with smtplib.SMTP('smtp.office365.com', 587) as smtp:
-        smtp.starttls()
-        smtp.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+    # Hand the email to the outbox, which stores it on disk and delivers it over a pooled Office 365 SMTP session
+    outbox.put(msg, job_id)
 
-def send_email_to_marketing(data):
+def send_email_to_marketing(post, job_id=None):
     msg = EmailMessage()
-    msg['Subject'] = f"New Branded Ad Request: {data.get('job_title', '')}"
+    msg['Subject'] = f"New Branded Ad Request: {post.job_title}"
     msg['From'] = EMAIL_USERNAME
     msg['To'] = MARKETING_EMAIL
 
     # Email content with submission details
     content = (
         f"A new branded ad request has been submitted with the following details:\n\n"
-        f"Email: {data.get('email', '')}\n"
-        f"Job Type: {data.get('job_type', '')}\n"
-        f"Job Title: {data.get('job_title', '')}\n"
-        f"Job Location: {data.get('job_location', '')}\n"
-        f"Job Salary: {data.get('job_salary', '')}\n"
-        f"Published Client: {data.get('published_client', '')}\n"
+        f"Email: {post.email}\n"
+        f"Job Type: {post.job_type}\n"
+        f"Job Title: {post.job_title}\n"
+        f"Job Location: {post.job_location}\n"
+        f"Job Salary: {post.job_salary}\n"
+        f"Published Client: {post.published_client}\n"
     )
     msg.set_content(content)
 
-    # Send email using Office 365 SMTP
-    with smtplib.SMTP('smtp.office365.com', 587) as smtp:
-        smtp.starttls()
-        smtp.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        smtp.send_message(msg)
-
-def check_incoming_emails():
-    try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        mail.select('inbox')
-
-        # Search for unseen emails from marketing team with attachments
-        status, messages = mail.search(None, f'(UNSEEN FROM "{MARKETING_EMAIL}")')
-        if status != 'OK':
-            print("No new emails found.")
-            mail.logout()
-            return
-
-        email_ids = messages[0].split()
-        for email_id in email_ids:
-            status, msg_data = mail.fetch(email_id, '(RFC822)')
-            if status != 'OK':
-                print(f"Failed to fetch email ID {email_id}")
+    # Hand the email to the outbox, which stores it on disk and delivers it over a pooled Office 365 SMTP session
+    outbox.put(msg, job_id)
+
+def check_incoming_emails(mail, uidvalidity):
+    # Called by the inbox watcher with an authenticated connection and the inbox selected.
+    # Only replies to branded ad requests from marketing newer than the last checkpoint are
+    # looked at, and only their JPEG attachments are downloaded.
+    criteria = f'FROM "{MARKETING_EMAIL}" SUBJECT "New Branded Ad Request"'
+    for uids in uid_sync.pending(mail, uidvalidity, criteria):
+        pending = []
+        try:
+            for uid, attributes in uid_sync.fetch(mail, uids):
+                save_templates(mail, uid, attributes['BODYSTRUCTURE'], pending)
+        finally:
+            # Downloads share the one connection; normalization runs in parallel meanwhile
+            finish_templates(pending)
+        # Everything up to the end of this chunk is done
+        uid_sync.checkpoint(uidvalidity, uids[-1])
+
+def save_templates(mail, uid, structure, pending):
+    # Downloads each new JPEG attachment and queues it for normalization,
+    # appending (name, save_path, download_path, future) to pending
+    for part in body_parts(structure):
+        if part.disposition is None:
+            continue
+        filename = part.filename
+        if filename and filename.lower().endswith(('.jpg', '.jpeg')):
+            brand_name = os.path.splitext(filename)[0]
+            # Replace spaces with underscores for filenames
+            sanitized_brand_name = brand_name.replace(" ", "_")
+            # Check if the brand already exists to prevent overwriting
+            save_filename = f"{sanitized_brand_name}.jpg"
+            save_path = os.path.join('static', 'BrandedAds', save_filename)
+            if os.path.exists(save_path) or any(item[0] == sanitized_brand_name for item in pending):
+                print(f"Template for brand '{sanitized_brand_name}' already exists. Skipping.")
                 continue
-
-            msg = email.message_from_bytes(msg_data[0][1])
-            subject = msg['Subject']
-            from_email = msg['From']
-
-            # Process only if it's a reply to the branded ad request
-            if "New Branded Ad Request" in subject:
-                for part in msg.walk():
-                    if part.get_content_maintype() == 'multipart':
-                        continue
-                    if part.get('Content-Disposition') is None:
-                        continue
-                    filename = part.get_filename()
-                    if filename and filename.lower().endswith(('.jpg', '.jpeg')):
-                        brand_name = os.path.splitext(filename)[0]
-                        # Replace spaces with underscores for filenames
-                        sanitized_brand_name = brand_name.replace(" ", "_")
-                        # Check if the brand already exists to prevent overwriting
-                        save_filename = f"{sanitized_brand_name}.jpg"
-                        save_path = os.path.join('static', 'BrandedAds', save_filename)
-                        if os.path.exists(save_path):
-                            print(f"Template for brand '{sanitized_brand_name}' already exists. Skipping.")
-                            continue
-                        # Save the attachment
-                        with open(save_path, 'wb') as f:
-                            f.write(part.get_payload(decode=True))
-                        print(f"Saved new branded ad template: {save_filename}")
-                # Mark email as seen
-                mail.store(email_id, '+FLAGS', '\\Seen')
-
-        mail.logout()
-    except Exception as e:
-        print(f"Error checking emails: {e}")
-
-# Schedule the email checker to run every 5 minutes
-scheduler.add_job(func=check_incoming_emails, trigger="interval", minutes=5)
+            # Stream the attachment to a temp file for the normalization workers
+            download_path = save_path + '.part'
+            try:
+                with open(download_path, 'wb') as f:
+                    download_part(mail, uid, part, f)
+            except BaseException:
+                os.remove(download_path)
+                raise
+            future = ingest_service.submit(normalize_template, download_path, save_path)
+            pending.append((sanitized_brand_name, save_path, download_path, future))
+
+def finish_templates(pending):
+    for name, save_path, download_path, future in pending:
+        try:
+            width, height = future.result()
+            # Record dimensions and checksum for the catalog and usage statistics
+            checksum = template_store.add(name, save_path, width, height)
+            print(f"Saved new branded ad template: {name}.jpg ({width}x{height})")
+            duplicates = [other for other in template_store.find_by_hash(checksum) if other != name]
+            if duplicates:
+                print(f"Template {name}.jpg is identical to {', '.join(duplicates)}")
+            template_catalog.invalidate()
+        except Exception as e:
+            print(f"Rejected branded ad template {name}.jpg: {e}")
+        finally:
+            os.remove(download_path)
+
+# Watch the inbox over IMAP IDLE so new templates are picked up as soon as they arrive
+uid_sync = UIDSync()
+inbox_watcher = InboxWatcher(check_incoming_emails, IMAP_SERVER, IMAP_PORT, EMAIL_USERNAME, EMAIL_PASSWORD)
+
+# Only one process (e.g. one of several gunicorn workers) runs the scheduler, the
+# inbox watcher and the outbox senders, so the per-mailbox send rate holds across
+# workers; the others leave their email on disk for it and take over if it dies
+leader = LeaderElection()
+# Pick up templates added or removed on disk while no leader was running
+leader.on_elected(sync_templates)
+leader.on_elected(scheduler.start, lambda: scheduler.shutdown())
+leader.on_elected(inbox_watcher.start, inbox_watcher.stop)
+leader.on_elected(outbox.start, outbox.close)
+leader.start()
+atexit.register(lambda: leader.stop())
+
+# Drain the durable job queue in the background; unfinished jobs are picked up again after a restart
+job_runner.register('submission', process_submission,
+                    permanent=(msgspec.ValidationError, FileNotFoundError))
+job_runner.start()
+atexit.register(lambda: job_runner.shutdown())
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5858)
\ No newline at end of file
@@ -0,0 +1,171 @@
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import msal
+import requests
+from requests.adapters import HTTPAdapter
+from database import Database
+
+# Azure AD client configuration
+AUTH_METADATA_TTL = float(os.getenv('AUTH_METADATA_TTL', 24 * 3600))
+AUTH_HTTP_POOL_SIZE = int(os.getenv('AUTH_HTTP_POOL_SIZE', 10))
+AUTH_HTTP_TIMEOUT = float(os.getenv('AUTH_HTTP_TIMEOUT', 10))
+
+# Per-user token caches for silent sign-in
+AUTH_CACHE_DB_PATH = os.getenv('AUTH_CACHE_DB_PATH', 'token_cache.db')
+AUTH_REMEMBER_SECONDS = int(os.getenv('AUTH_REMEMBER_SECONDS', 14 * 24 * 3600))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_caches (
+    account TEXT PRIMARY KEY,
+    cache TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS token_caches_updated ON token_caches (updated);
+"""
+
+# Signed-in user kept in the session
+SESSION_USER_TTL = int(os.getenv('SESSION_USER_TTL', 12 * 3600))
+SESSION_USER_MAX_BYTES = int(os.getenv('SESSION_USER_MAX_BYTES', 256))
+
+# version, expiry, object id, tenant id, then the lengths of the UTF-8
+# username and display name, which follow the header
+USER_HEADER = struct.Struct('<BI16s16sBB')
+USER_VERSION = 1
+SessionUser = namedtuple('SessionUser', ['username', 'name', 'oid', 'tid', 'expires'])
+
+class _TimeoutSession(requests.Session):
+    # requests has no session-wide timeout; MSAL passes none of its own
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+class MSALClient:
+    # One msal.ConfidentialClientApplication per process instead of one per
+    # request. Building an application fetches the authority's OpenID
+    # configuration (and runs instance discovery); the shared application and
+    # the HTTP response cache holding that metadata are kept for ttl seconds
+    # and then rebuilt, so metadata changes are still picked up. Every call
+    # goes through one pooled requests.Session, so connections to Azure AD are
+    # reused. Extra keyword arguments are passed to the application.
+    def __init__(self, client_id, client_credential, authority, ttl=AUTH_METADATA_TTL,
+                 pool_size=AUTH_HTTP_POOL_SIZE, timeout=AUTH_HTTP_TIMEOUT, **options):
+        self.client_id = client_id
+        self.client_credential = client_credential
+        self.authority = authority
+        self.ttl = ttl
+        self.options = options
+        self.http_client = _TimeoutSession(timeout)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http_client.mount('https://', adapter)
+        self._http_cache = {}
+        self._app = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        # The shared application, built on first use and after the TTL expires
+        with self._lock:
+            if self._app is None or time.monotonic() >= self._expires:
+                self._http_cache = {}
+                self._app = self._build(None)
+                self._expires = time.monotonic() + self.ttl
+            return self._app
+
+    def with_token_cache(self, token_cache):
+        # A throwaway application bound to one user's token cache. It shares
+        # the pooled session and the cached authority metadata, so building
+        # it makes no network calls.
+        self.get()
+        return self._build(token_cache)
+
+    def _build(self, token_cache):
+        return msal.ConfidentialClientApplication(
+            self.client_id, authority=self.authority,
+            client_credential=self.client_credential, token_cache=token_cache,
+            http_client=self.http_client, http_cache=self._http_cache, **self.options)
+
+def _uuid_bytes(value):
+    try:
+        return uuid.UUID(value).bytes
+    except (TypeError, ValueError):
+        return bytes(16)
+
+def pack_user(claims, ttl=SESSION_USER_TTL):
+    # The few id token claims the application uses, in a fixed binary layout
+    # of at most SESSION_USER_MAX_BYTES
+    username = claims.get('preferred_username', '').encode()
+    room = SESSION_USER_MAX_BYTES - USER_HEADER.size - len(username)
+    if len(username) > 255 or room < 0:
+        raise ValueError(f"Username is too long for the {SESSION_USER_MAX_BYTES} byte session budget")
+    # The display name gets whatever space is left, cut on a character boundary
+    name = claims.get('name', '').encode()[:min(room, 255)].decode(errors='ignore').encode()
+    return USER_HEADER.pack(
+        USER_VERSION, int(time.time() + ttl), _uuid_bytes(claims.get('oid')),
+        _uuid_bytes(claims.get('tid')), len(username), len(name)) + username + name
+
+def unpack_user(data):
+    # The SessionUser packed into data, or None if there is none, it is
+    # malformed or it has expired
+    if not isinstance(data, bytes) or len(data) < USER_HEADER.size:
+        return None
+    version, expires, oid, tid, username_len, name_len = USER_HEADER.unpack_from(data)
+    if version != USER_VERSION or expires <= time.time():
+        return None
+    if len(data) != USER_HEADER.size + username_len + name_len:
+        return None
+    username = data[USER_HEADER.size:USER_HEADER.size + username_len].decode()
+    name = data[USER_HEADER.size + username_len:].decode()
+    # Object and tenant ids as 32 hex digits, without the dashes
+    return SessionUser(username, name, oid.hex(), tid.hex(), expires)
+
+class TokenCacheStore:
+    # Each signed-in user's serialized msal.SerializableTokenCache in a
+    # WAL-mode SQLite file, keyed by MSAL home account id, so any worker can
+    # refresh the user's tokens silently. Caches not used for ttl seconds are
+    # treated as gone and pruned.
+    def __init__(self, path=AUTH_CACHE_DB_PATH, ttl=AUTH_REMEMBER_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._db = Database(path, SCHEMA)
+        self._last_prune = 0
+
+    def load(self, account):
+        # The account's cache, or None if there is none or it has expired
+        row = self._db.connect().execute(
+            "SELECT cache FROM token_caches WHERE account = ? AND updated >= ?",
+            (account, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        cache = msal.SerializableTokenCache()
+        cache.deserialize(row[0])
+        return cache
+
+    def save(self, account, cache):
+        now = time.time()
+        with self._db.connect() as db:
+            if cache.has_state_changed:
+                db.execute(
+                    "INSERT OR REPLACE INTO token_caches (account, cache, updated) VALUES (?, ?, ?)",
+                    (account, cache.serialize(), now))
+                cache.has_state_changed = False
+            else:
+                db.execute("UPDATE token_caches SET updated = ? WHERE account = ?", (now, account))
+            if now - self._last_prune > 3600:
+                self._last_prune = now
+                db.execute("DELETE FROM token_caches WHERE updated < ?", (now - self.ttl,))
+
+    def delete(self, account):
+        with self._db.connect() as db:
+            db.execute("DELETE FROM token_caches WHERE account = ?", (account,))
+
+
+token_cache_store = TokenCacheStore()
@@ -0,0 +1,53 @@
+# Font-fit benchmark: p50/p99 fit time against job title length.
+# Run from the repository root: python benchmarks/bench_font_fit.py [font_path]
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import ImageFont
+
+from imaging import FONT_PATH, MIN_FONT_SIZE, fit_font, measure_text, _measure_draw
+
+ITERATIONS = 50
+TITLE_LENGTHS = [10, 40, 80, 160, 320]
+
+def linear_fit(text, max_width, max_height, max_size, font_path=FONT_PATH):
+    # The original one-point-at-a-time loop, kept for comparison
+    font_size = max_size
+    font = ImageFont.truetype(font_path, font_size)
+    while True:
+        left, top, right, bottom = _measure_draw.multiline_textbbox((0, 0), text, font=font)
+        if right - left <= max_width and bottom - top <= max_height:
+            break
+        font_size -= 1
+        if font_size < MIN_FONT_SIZE:
+            break
+        font = ImageFont.truetype(font_path, font_size)
+    return font
+
+def percentiles(samples):
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return p50 * 1000, p99 * 1000
+
+def run(label, fit, text, font_path):
+    samples = []
+    for _ in range(ITERATIONS):
+        measure_text.cache_clear()
+        start = time.perf_counter()
+        fit(text, 1000, 1000, 100, font_path=font_path)
+        samples.append(time.perf_counter() - start)
+    p50, p99 = percentiles(samples)
+    print(f"{label:<8} {len(text):>6} {p50:>10.2f} {p99:>10.2f}")
+
+if __name__ == '__main__':
+    font_path = sys.argv[1] if len(sys.argv) > 1 else FONT_PATH
+    print(f"{'solver':<8} {'chars':>6} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for length in TITLE_LENGTHS:
+        text = f"{'Senior Engineer ' * (length // 16 + 1)}"[:length] + "\nLeeds\n£45,000"
+        run('linear', linear_fit, text, font_path)
+        run('search', fit_font, text, font_path)
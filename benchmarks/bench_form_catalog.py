@@ -0,0 +1,76 @@
+# Template catalog benchmark: GET /form latency with 10, 1,000 and 10,000
+# branded ad templates, listing the directory on every request as the view
+# used to versus the current form, which looks templates up as the user
+# types, plus a typeahead query against /templates/search served from the
+# in-memory TemplateCatalog. The page variants render the real
+# templates/index.html through a bare Flask app, so the numbers include page
+# rendering but not login or the rest of app.py's start-up.
+# Run from the repository root: python benchmarks/bench_form_catalog.py [requests]
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask import Flask, jsonify, render_template, request
+
+from catalog import TemplateCatalog, TemplateStore
+
+SIZES = (10, 1000, 10000)
+
+def make_app(directory, store):
+    app = Flask(__name__, template_folder=os.path.join(ROOT, 'templates'))
+    catalog = TemplateCatalog(store)
+
+    @app.route('/form-listdir')
+    def form_listdir():
+        templates = sorted([
+            {
+                'filename': f[:-4],
+                'display_name': f[:-4].replace("_", " ")
+            }
+            for f in os.listdir(directory) if f.endswith('.jpg')
+        ], key=lambda x: x['display_name'])
+        return render_template('index.html', data={}, templates=templates)
+
+    @app.route('/form-search')
+    def form_search():
+        return render_template('index.html', data={})
+
+    # Same endpoint name as app.py so the form's url_for() resolves
+    @app.route('/templates/search', endpoint='search_templates')
+    def search():
+        total, results = catalog.search(request.args.get('q', ''))
+        return jsonify({'total': total, 'results': results})
+
+    return app
+
+def measure(client, path, requests):
+    client.get(path)
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get(path)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000
+
+def main(requests):
+    print(f"{'templates':>10} {'variant':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for size in SIZES:
+        directory = tempfile.mkdtemp()
+        store = TemplateStore(os.path.join(directory, 'templates.db'))
+        for n in range(size):
+            path = os.path.join(directory, f'Brand_{n:05d}.jpg')
+            open(path, 'wb').close()
+            store.add(f'Brand_{n:05d}', path, 1080, 1080)
+        client = make_app(directory, store).test_client()
+        for variant, path in (('listdir', '/form-listdir'), ('form', '/form-search'),
+                              ('search', '/templates/search?q=brand+0001')):
+            p50, p99 = measure(client, path, requests)
+            print(f"{size:>10} {variant:>8} {p50:>9.2f} {p99:>9.2f}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
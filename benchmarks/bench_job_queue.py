@@ -0,0 +1,68 @@
+# Job queue benchmark: sustained enqueue/dequeue throughput and crash recovery.
+# A child process drains part of the queue and is SIGKILLed mid-run; the jobs
+# it had leased must be redelivered once their visibility timeout expires.
+# Run from the repository root: python benchmarks/bench_job_queue.py [jobs]
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobs import JobQueue, JobRunner
+
+VISIBILITY_TIMEOUT = 1.0
+
+def crashing_worker(path):
+    queue = JobQueue(path, visibility_timeout=VISIBILITY_TIMEOUT)
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            return
+        job, _, payload = claimed
+        # Leave every tenth job leased and unfinished, as a crash mid-job would
+        if payload['n'] % 10:
+            queue.complete(job)
+
+def main(total):
+    path = os.path.join(tempfile.mkdtemp(), 'jobs.db')
+    queue = JobQueue(path, visibility_timeout=VISIBILITY_TIMEOUT)
+
+    start = time.perf_counter()
+    for n in range(total):
+        queue.enqueue('bench', {'n': n})
+    enqueue_rate = total / (time.perf_counter() - start)
+
+    child = multiprocessing.Process(target=crashing_worker, args=(path,))
+    child.start()
+    time.sleep(0.5)
+    os.kill(child.pid, signal.SIGKILL)
+    child.join()
+
+    db = queue._db.connect()
+    drained_before_crash = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'done'").fetchone()[0]
+    leased = db.execute(
+        "SELECT COUNT(*) FROM jobs WHERE status != 'done' AND visible_at > ?", (time.time(),)).fetchone()[0]
+
+    seen = set()
+    runner = JobRunner(queue, workers=4, poll_interval=0.05)
+    runner.register('bench', lambda job, n: seen.add(n))
+    start = time.perf_counter()
+    runner.start()
+    while db.execute("SELECT COUNT(*) FROM jobs WHERE visible_at IS NOT NULL").fetchone()[0]:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    runner.shutdown()
+
+    done = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'done'").fetchone()[0]
+    print(f"enqueue:             {enqueue_rate:10.0f} jobs/s")
+    print(f"drained before crash:{drained_before_crash:10d}")
+    print(f"leased at crash:     {leased:10d}")
+    print(f"dequeue after crash: {len(seen) / elapsed:10.0f} jobs/s ({len(seen)} jobs, "
+          f"includes {VISIBILITY_TIMEOUT:.0f}s visibility timeout)")
+    print(f"lost:                {total - done:10d}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,190 @@
+# MSAL client benchmark against a local mock Azure AD authority served over
+# HTTPS with a self-signed certificate. Each simulated login builds the
+# authorization URL and then redeems an authorization code, once with a new
+# ConfidentialClientApplication per step (as app.py used to) and once with
+# the shared MSALClient. Every request to the mock authority costs rtt_ms to
+# stand in for the round trip to Azure AD; the report shows discovery
+# requests, new TLS connections and latency per login.
+# Run from the repository root: python benchmarks/bench_msal_client.py [logins] [rtt_ms]
+import base64
+import datetime
+import json
+import os
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msal
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from auth import MSALClient
+
+CLIENT_ID = 'bench-client'
+TENANT = 'bench-tenant'
+SCOPE = ["User.Read"]
+REDIRECT_URI = 'http://localhost/getAToken'
+
+def make_certificate(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName('localhost')]), critical=False)
+            .sign(key, hashes.SHA256()))
+    cert_path = os.path.join(directory, 'cert.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+def unsigned_jwt(claims):
+    # MSAL reads the claims of an id_token it just received over TLS without checking the signature
+    def encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b'=').decode()
+    return f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(claims)}."
+
+class MockAuthorityHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.server.pause()
+        if self.path.endswith('/.well-known/openid-configuration'):
+            self.server.count('discovery')
+            base = self.server.base_url
+            self.reply({
+                'issuer': f'{base}/{TENANT}/v2.0',
+                'authorization_endpoint': f'{base}/{TENANT}/oauth2/v2.0/authorize',
+                'token_endpoint': f'{base}/{TENANT}/oauth2/v2.0/token',
+                'jwks_uri': f'{base}/{TENANT}/discovery/v2.0/keys',
+            })
+        else:
+            self.reply({'error': 'not_found'}, 404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.pause()
+        self.server.count('token')
+        now = int(time.time())
+        self.reply({
+            'token_type': 'Bearer',
+            'access_token': 'bench-access-token',
+            'expires_in': 3600,
+            'scope': ' '.join(SCOPE),
+            'id_token': unsigned_jwt({
+                'iss': f'{self.server.base_url}/{TENANT}/v2.0',
+                'aud': CLIENT_ID,
+                'iat': now,
+                'nbf': now,
+                'exp': now + 3600,
+                'sub': 'bench-user',
+                'oid': 'bench-user',
+                'tid': TENANT,
+                'preferred_username': 'recruiter@jacksonhogg.com',
+            }),
+        })
+
+    def reply(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class MockAuthority(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cert_path, key_path, rtt):
+        super().__init__(('localhost', 0), MockAuthorityHandler)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert_path, key_path)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.base_url = f'https://localhost:{self.server_address[1]}'
+        self.rtt = rtt
+        self.lock = threading.Lock()
+        self.reset()
+
+    def pause(self):
+        time.sleep(self.rtt)
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def reset(self):
+        self.connections = 0
+        self.requests = {}
+
+def login_per_request(authority):
+    # The old build_msal_app(): a new application, and HTTP session, for every step
+    def build():
+        return msal.ConfidentialClientApplication(
+            CLIENT_ID, authority=authority, client_credential='secret',
+            instance_discovery=False)
+    build().get_authorization_request_url(SCOPE, redirect_uri=REDIRECT_URI)
+    return build().acquire_token_by_authorization_code('code', scopes=SCOPE, redirect_uri=REDIRECT_URI)
+
+def login_shared(client):
+    client.get().get_authorization_request_url(SCOPE, redirect_uri=REDIRECT_URI)
+    return client.get().acquire_token_by_authorization_code('code', scopes=SCOPE, redirect_uri=REDIRECT_URI)
+
+def run(server, logins, login):
+    server.reset()
+    timings = []
+    for _ in range(logins):
+        start = time.perf_counter()
+        result = login()
+        timings.append(time.perf_counter() - start)
+        if 'error' in result:
+            raise RuntimeError(f"Login failed: {result}")
+    timings.sort()
+    return {
+        'p50_ms': round(timings[len(timings) // 2] * 1000, 1),
+        'p99_ms': round(timings[int(len(timings) * 0.99)] * 1000, 1),
+        'discovery_per_login': server.requests.get('discovery', 0) / logins,
+        'token_per_login': server.requests.get('token', 0) / logins,
+        'connections_per_login': server.connections / logins,
+    }
+
+def main(logins, rtt_ms):
+    cert_path, key_path = make_certificate(tempfile.mkdtemp())
+    server = MockAuthority(cert_path, key_path, rtt_ms / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    authority = f'{server.base_url}/{TENANT}'
+    # Trust the mock's certificate; requests prefers this over a session's verify setting
+    os.environ['REQUESTS_CA_BUNDLE'] = cert_path
+
+    client = MSALClient(CLIENT_ID, 'secret', authority, instance_discovery=False)
+
+    print(f"{logins} logins, {rtt_ms} ms simulated round trip to the authority")
+    print('per-request apps:', run(server, logins, lambda: login_per_request(authority)))
+    print('shared client:   ', run(server, logins, lambda: login_shared(client)))
+
+if __name__ == '__main__':
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rtt_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(logins, rtt_ms)
@@ -0,0 +1,95 @@
+# Session backend benchmark: per-request cost of reading and writing a
+# signed-in user's session with 10,000 active sessions, for the Flask-Session
+# filesystem store app.py used to configure, the SQLite store in sessions.py
+# and Flask's built-in signed cookie sessions. Each request goes through a
+# bare Flask app's test client carrying one of the sessions' cookies, picked
+# at random; "read" only looks at the session, "write" changes it. Reads
+# that find the user signed out are counted as lost sessions: the
+# filesystem store prunes itself down once it holds more than 500. The
+# filesystem baseline needs Flask-Session installed.
+# Run from the repository root: python benchmarks/bench_sessions.py [sessions] [requests]
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, session
+
+from sessions import SessionStore, SQLiteSessionInterface
+
+# Roughly what Azure AD puts in id_token_claims
+CLAIMS = {
+    'aud': '00000000-0000-0000-0000-000000000000',
+    'iss': 'https://login.microsoftonline.com/00000000-0000-0000-0000-000000000000/v2.0',
+    'iat': 1700000000, 'nbf': 1700000000, 'exp': 1700003600,
+    'name': 'Recruiter', 'oid': '00000000-0000-0000-0000-000000000000',
+    'preferred_username': 'recruiter@jacksonhogg.com',
+    'rh': '0.AAAA' + 'x' * 60, 'sub': 'y' * 43,
+    'tid': '00000000-0000-0000-0000-000000000000', 'uti': 'z' * 22, 'ver': '2.0',
+}
+
+def make_app(backend, directory):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'bench'
+    if backend == 'filesystem':
+        from flask_session import Session
+        app.config['SESSION_TYPE'] = 'filesystem'
+        app.config['SESSION_FILE_DIR'] = os.path.join(directory, 'flask_session')
+        Session(app)
+    elif backend == 'sqlite':
+        app.session_interface = SQLiteSessionInterface(SessionStore(os.path.join(directory, 'sessions.db')))
+
+    @app.route('/login/<int:n>')
+    def login(n):
+        session['user'] = dict(CLAIMS, name=f'Recruiter {n}')
+        return ''
+
+    @app.route('/read')
+    def read():
+        return 'found' if 'user' in session else 'lost'
+
+    @app.route('/write')
+    def write():
+        session['last_form'] = time.time()
+        return ''
+
+    return app
+
+def session_cookie(response):
+    for header in response.headers.getlist('Set-Cookie'):
+        if header.startswith('session='):
+            return header.split(';', 1)[0]
+    raise RuntimeError('No session cookie set')
+
+def measure(client, cookies, path, requests):
+    timings = []
+    lost = 0
+    for _ in range(requests):
+        cookie = random.choice(cookies)
+        start = time.perf_counter()
+        response = client.get(path, headers={'Cookie': cookie})
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}")
+        lost += response.data == b'lost'
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000, lost
+
+def main(sessions, requests):
+    print(f"{sessions} active sessions, {requests} requests per variant")
+    print(f"{'backend':>10} {'op':>6} {'p50 ms':>9} {'p99 ms':>9} {'lost':>6}")
+    for backend in ('filesystem', 'sqlite', 'cookie'):
+        app = make_app(backend, tempfile.mkdtemp())
+        client = app.test_client(use_cookies=False)
+        cookies = [session_cookie(client.get(f'/login/{n}')) for n in range(sessions)]
+        for op in ('read', 'write'):
+            p50, p99, lost = measure(client, cookies, f'/{op}', requests)
+            print(f"{backend:>10} {op:>6} {p50:>9.3f} {p99:>9.3f} {lost if op == 'read' else '':>6}")
+
+if __name__ == '__main__':
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    main(sessions, requests)
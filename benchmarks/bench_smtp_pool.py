@@ -0,0 +1,85 @@
+# SMTP benchmark: messages per second with a new connection per message (the
+# original send path) against the pooled sessions in mailer.SMTPPool.
+# A local fake SMTP server adds a fixed delay to every reply to stand in for
+# the round trip to Office 365. STARTTLS is not used against the fake server.
+# Run from the repository root: python benchmarks/bench_smtp_pool.py [messages] [rtt_ms]
+import os
+import smtplib
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailer import SMTPPool
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    rtt = 0.0
+
+    def reply(self, line):
+        time.sleep(self.rtt)
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost fake SMTP')
+        for raw in self.rfile:
+            command = raw.decode('ascii', 'replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 SIZE 35882577')
+            elif command.startswith('AUTH'):
+                self.reply('235 2.7.0 Authentication successful')
+            elif command == 'DATA':
+                self.reply('354 Start mail input')
+                for line in self.rfile:
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                self.reply('250 2.0.0 OK queued')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def build_message(n):
+    msg = EmailMessage()
+    msg['Subject'] = f"LinkedIn Post: Benchmark {n}"
+    msg['From'] = 'sender@example.com'
+    msg['To'] = 'recipient@example.com'
+    msg.set_content('This is an auto-generated image.')
+    msg.add_attachment(b'\xff\xd8' + b'\0' * 30000, maintype='image', subtype='jpeg', filename='job_post.jpeg')
+    return msg
+
+def send_unpooled(port, msg):
+    with smtplib.SMTP('127.0.0.1', port) as smtp:
+        smtp.login('user', 'password')
+        smtp.send_message(msg)
+
+def run(label, send, messages, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, messages))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {concurrency:>11} {len(messages) / elapsed:>10.1f}")
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    FakeSMTPHandler.rtt = (float(sys.argv[2]) if len(sys.argv) > 2 else 5) / 1000
+    server = FakeSMTPServer(('127.0.0.1', 0), FakeSMTPHandler)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    messages = [build_message(n) for n in range(total)]
+    print(f"{'mode':<10} {'concurrency':>11} {'msgs/s':>10}")
+    for concurrency in (1, 4):
+        run('unpooled', lambda msg: send_unpooled(port, msg), messages, concurrency)
+        pool = SMTPPool('user', 'password', host='127.0.0.1', port=port, starttls=False, size=concurrency)
+        run('pooled', pool.send, messages, concurrency)
+        pool.close()
+    server.shutdown()
@@ -0,0 +1,220 @@
+import bisect
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from PIL import Image
+from database import Database
+
+# Template catalog configuration
+TEMPLATE_DIR = os.path.join('static', 'BrandedAds')
+TEMPLATE_DB_PATH = os.getenv('TEMPLATE_DB_PATH', 'templates.db')
+CATALOG_CHECK_INTERVAL = float(os.getenv('CATALOG_CHECK_INTERVAL', 2))
+TEMPLATE_SYNC_INTERVAL = float(os.getenv('TEMPLATE_SYNC_INTERVAL', 10))
+TEMPLATE_IDLE_SECONDS = float(os.getenv('TEMPLATE_IDLE_SECONDS', 7 * 24 * 3600))
+SEARCH_MAX_LIMIT = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS templates (
+    name TEXT PRIMARY KEY,
+    display_name TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    ingested REAL NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 0,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS templates_display_name ON templates (display_name);
+CREATE INDEX IF NOT EXISTS templates_sha256 ON templates (sha256);
+CREATE INDEX IF NOT EXISTS templates_last_used ON templates (last_used);
+"""
+
+COLUMNS = ('name', 'display_name', 'width', 'height', 'size', 'sha256', 'ingested', 'uses', 'last_used')
+
+class TemplateStore:
+    # Metadata for every branded ad template in a WAL-mode SQLite file: pixel
+    # dimensions, file size and checksum, when it was ingested, and how often
+    # and how recently it was rendered. The ingester adds rows, every render
+    # bumps the usage counters, and readers ask the store rather than the
+    # filesystem. The database's user_version is bumped whenever templates
+    # are added or removed, so readers can cheaply tell whether the list of
+    # templates has changed.
+    def __init__(self, path=TEMPLATE_DB_PATH):
+        self.path = path
+        self._db = Database(path, SCHEMA)
+        self._synced_mtime = None
+
+    def add(self, name, file_path, width, height):
+        digest = hashlib.sha256()
+        size = 0
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+                size += len(block)
+        db = self._db.connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "INSERT OR REPLACE INTO templates (name, display_name, width, height, size, sha256, ingested) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, name.replace("_", " "), width, height, size, digest.hexdigest(), time.time()))
+            self._bump_version(db)
+        return digest.hexdigest()
+
+    def remove(self, name):
+        db = self._db.connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("DELETE FROM templates WHERE name = ?", (name,)).rowcount:
+                self._bump_version(db)
+
+    def record_use(self, name):
+        # Best effort: usage statistics must never fail a render
+        try:
+            with self._db.connect() as db:
+                db.execute(
+                    "UPDATE templates SET uses = uses + 1, last_used = ? WHERE name = ?",
+                    (time.time(), name))
+        except sqlite3.Error as e:
+            print(f"Error recording template use: {e}")
+
+    def get(self, name):
+        row = self._db.connect().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM templates WHERE name = ?", (name,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def find_by_hash(self, sha256):
+        rows = self._db.connect().execute(
+            "SELECT name FROM templates WHERE sha256 = ?", (sha256,)).fetchall()
+        return [row[0] for row in rows]
+
+    def names(self):
+        # (name, display_name) pairs in display order
+        return self._db.connect().execute(
+            "SELECT name, display_name FROM templates ORDER BY display_name").fetchall()
+
+    def most_used(self, limit, since=0):
+        # Names of the templates rendered most since the given time, busiest first
+        rows = self._db.connect().execute(
+            "SELECT name FROM templates WHERE last_used >= ? ORDER BY uses DESC, last_used DESC LIMIT ?",
+            (since, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def unused_since(self, before):
+        # Names of templates not rendered since before, oldest first; a template
+        # that was never rendered counts from when it was ingested
+        rows = self._db.connect().execute(
+            "SELECT name FROM templates WHERE COALESCE(last_used, ingested) < ? "
+            "ORDER BY COALESCE(last_used, ingested)", (before,)).fetchall()
+        return [row[0] for row in rows]
+
+    def version(self):
+        return self._db.connect().execute("PRAGMA user_version").fetchone()[0]
+
+    def sync(self, directory=TEMPLATE_DIR):
+        # Reconciles the store with the .jpg files in directory, adding rows
+        # for files it has not seen and dropping rows for files that are gone.
+        # Returns the (added, removed) names.
+        os.makedirs(directory, exist_ok=True)
+        self._synced_mtime = os.stat(directory).st_mtime_ns
+        on_disk = {f[:-4] for f in os.listdir(directory) if f.endswith('.jpg')}
+        known = {name for name, _ in self.names()}
+        added = []
+        for name in on_disk - known:
+            file_path = os.path.join(directory, name + '.jpg')
+            try:
+                with Image.open(file_path) as img:
+                    width, height = img.size
+            except Exception as e:
+                print(f"Skipping unreadable template {name}: {e}")
+                continue
+            self.add(name, file_path, width, height)
+            added.append(name)
+        removed = sorted(known - on_disk)
+        for name in removed:
+            self.remove(name)
+        return added, removed
+
+    def sync_if_changed(self, directory=TEMPLATE_DIR):
+        # sync() only when files were added, removed or renamed in directory
+        # since the last sync, which one stat() of the directory tells
+        try:
+            if os.stat(directory).st_mtime_ns == self._synced_mtime:
+                return [], []
+        except FileNotFoundError:
+            pass
+        return self.sync(directory)
+
+    def _bump_version(self, db):
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        db.execute(f"PRAGMA user_version = {version + 1}")
+
+class TemplateCatalog:
+    # The templates in a TemplateStore with their display names and sort
+    # order held in memory. The store's version is looked at no more than
+    # once every check_interval seconds and the list is reloaded only when it
+    # has changed, so most requests make no database or filesystem calls.
+    # invalidate() forces a check on the next read, for changes made by
+    # this process. search() answers typeahead queries from a sorted index of
+    # (word, position) pairs, so every query word is a bisect prefix lookup.
+    def __init__(self, store, check_interval=CATALOG_CHECK_INTERVAL):
+        self.store = store
+        self.check_interval = check_interval
+        # (templates, words) swapped in as one tuple so readers see a consistent pair
+        self._snapshot = ((), ())
+        self._version = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+    def search(self, query, offset=0, limit=20):
+        # Returns (total, page) of templates with a word starting with each
+        # word of query, case-insensitively, in catalog order
+        if time.monotonic() >= self._next_check:
+            self._refresh()
+        templates, words = self._snapshot
+        limit = max(0, min(limit, SEARCH_MAX_LIMIT))
+        offset = max(0, offset)
+        matches = None
+        for term in query.lower().split():
+            found = set()
+            i = bisect.bisect_left(words, (term,))
+            while i < len(words) and words[i][0].startswith(term):
+                found.add(words[i][1])
+                i += 1
+            matches = found if matches is None else matches & found
+            if not matches:
+                return 0, []
+        if matches is None:
+            return len(templates), list(templates[offset:offset + limit])
+        positions = sorted(matches)
+        return len(positions), [templates[i] for i in positions[offset:offset + limit]]
+
+    def invalidate(self):
+        self._next_check = 0
+
+    def _refresh(self):
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return
+            try:
+                version = self.store.version()
+                if version != self._version:
+                    templates = tuple(
+                        {'filename': name, 'display_name': display_name}
+                        for name, display_name in self.store.names())
+                    words = sorted(
+                        (word, position)
+                        for position, template in enumerate(templates)
+                        for word in set(template['display_name'].lower().split()))
+                    self._snapshot = (templates, tuple(words))
+                    self._version = version
+            except sqlite3.Error as e:
+                # Keep serving the last good list
+                print(f"Error loading template catalog: {e}")
+            self._next_check = time.monotonic() + self.check_interval
+
+template_store = TemplateStore()
+template_catalog = TemplateCatalog(template_store)
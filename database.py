@@ -0,0 +1,27 @@
+import sqlite3
+import threading
+
+class Database:
+    # Connections to one WAL-mode SQLite file, one per thread. The schema
+    # script runs on the first connection made by this object. Connections
+    # are in autocommit mode: use `with db:` (plus BEGIN IMMEDIATE where a
+    # read must not race other writers) to group statements in a transaction.
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    db.executescript(self.schema)
+                    self._schema_ready = True
+            self._local.db = db
+        return db
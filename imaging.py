@@ -0,0 +1,507 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+# Font configuration
+FONT_PATH = os.path.join('static', 'fonts', 'PTSans-Regular.ttf')
+MIN_FONT_SIZE = 10
+MAX_FONT_SIZE = 100
+FONT_CACHE_SIZE = int(os.getenv('FONT_CACHE_SIZE', 128))
+
+# Decoded template cache budget
+TEMPLATE_CACHE_BYTES = int(os.getenv('TEMPLATE_CACHE_MB', 256)) * 1024 * 1024
+
+# Decoded templates shared between processes; an empty directory disables sharing
+TEMPLATE_SHM_DIR = os.getenv('TEMPLATE_SHM_DIR', '/dev/shm/jobpost-templates' if os.path.isdir('/dev/shm') else '')
+TEMPLATE_SHM_BYTES = int(os.getenv('TEMPLATE_SHM_MB', 192)) * 1024 * 1024
+SHARED_MAGIC = b'JPTX'
+SHARED_HEADER = struct.Struct('<4sII4x')
+
+# Incoming template normalization: longest side in pixels and JPEG quality
+TEMPLATE_MAX_SIDE = int(os.getenv('TEMPLATE_MAX_SIDE', 1080))
+TEMPLATE_QUALITY = int(os.getenv('TEMPLATE_QUALITY', 95))
+
+# Rendered ad cache configuration
+RENDER_CACHE_BYTES = int(os.getenv('RENDER_CACHE_MB', 64)) * 1024 * 1024
+RENDER_DISK_CACHE_BYTES = int(os.getenv('RENDER_DISK_CACHE_MB', 512)) * 1024 * 1024
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', 'render_cache')
+RENDER_DISK_SCAN_INTERVAL = float(os.getenv('RENDER_DISK_SCAN_INTERVAL', 60))
+# Bump whenever the drawing code changes so stale renders are not served
+RENDER_VERSION = 1
+
+# Scratch surface used only for measuring text, never drawn onto the output
+_measure_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+class FontRegistry:
+    # Process-wide font store: each font file is read from disk once, and
+    # size-specific FreeTypeFont objects are kept in a bounded LRU.
+    def __init__(self, max_fonts=FONT_CACHE_SIZE):
+        self.max_fonts = max_fonts
+        self.hits = 0
+        self.misses = 0
+        self._files = {}
+        self._fonts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, font_size, font_path=FONT_PATH):
+        key = (font_path, font_size)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                self.hits += 1
+                return font
+            self.misses += 1
+            data = self._files.get(font_path)
+            if data is None:
+                with open(font_path, 'rb') as f:
+                    data = self._files[font_path] = f.read()
+            font = ImageFont.truetype(io.BytesIO(data), font_size)
+            self._fonts[key] = font
+            if len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+            return font
+
+    def warm(self, sizes=range(MIN_FONT_SIZE, MAX_FONT_SIZE + 1), font_path=FONT_PATH):
+        for size in sizes:
+            self.get(size, font_path)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'fonts': len(self._fonts)}
+
+font_registry = FontRegistry()
+
+def font_stats():
+    # Module-level so render workers can be asked for it through the pool
+    return font_registry.stats()
+
+def load_font(font_size, font_path=FONT_PATH):
+    return font_registry.get(font_size, font_path)
+
+class TemplateCache:
+    # Decoded template bitmaps in a byte-budgeted LRU, checked against each
+    # file's mtime and size; with shared_dir set, one RGBX copy per template is
+    # mapped read-only by every worker. Callers get a private RGB copy.
+    def __init__(self, max_bytes=TEMPLATE_CACHE_BYTES, shared_dir=TEMPLATE_SHM_DIR,
+                 max_shared_bytes=TEMPLATE_SHM_BYTES):
+        self.max_bytes = max_bytes
+        self.shared_dir = shared_dir
+        self.max_shared_bytes = max_shared_bytes
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self._bytes = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template_path):
+        # Returns a private copy the caller is free to draw on
+        stat = os.stat(template_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._images.get(template_path)
+            if entry is not None and entry[0] == signature:
+                self._images.move_to_end(template_path)
+                self.hits += 1
+                return self._private_copy(entry[1])
+            self.misses += 1
+
+        img = self._map_shared(template_path, signature)
+        if img is None:
+            with Image.open(template_path) as src:
+                img = src.convert('RGB')
+            img = self.publish(template_path, img, signature) or img
+        else:
+            with self._lock:
+                self.shared_hits += 1
+
+        with self._lock:
+            self._discard(template_path)
+            size = img.width * img.height * len(img.mode)
+            if size <= self.max_bytes:
+                self._images[template_path] = (signature, img)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    self._discard(next(iter(self._images)))
+        return self._private_copy(img)
+
+    def publish(self, template_path, img, signature=None):
+        # Writes img as the shared decoded copy of template_path and returns
+        # it mapped from there, or None if there is no usable shared directory
+        if not self.shared_dir:
+            return None
+        if signature is None:
+            stat = os.stat(template_path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        prefix = self._shared_prefix(template_path)
+        path = f"{prefix}-{signature[0]}-{signature[1]}.rgbx"
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.shared_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(SHARED_HEADER.pack(SHARED_MAGIC, img.width, img.height))
+                f.write(img.convert('RGBX').tobytes())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # Typically a full tmpfs; fall back to a private decoded copy
+            print(f"Error writing shared template {template_path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+        self._prune_shared(keep=path, stale_prefix=os.path.basename(prefix) + '-')
+        return self._map_shared(template_path, signature)
+
+    def invalidate(self, template_path=None):
+        with self._lock:
+            if template_path is None:
+                self._images.clear()
+                self._bytes = 0
+            else:
+                self._discard(template_path)
+
+    def drop_shared(self, template_paths):
+        # Removes the shared decoded copies of the given templates, e.g. ones
+        # deleted or no longer in use; workers still mapping them keep their copy
+        if not self.shared_dir or not os.path.isdir(self.shared_dir):
+            return 0
+        prefixes = {os.path.basename(self._shared_prefix(path)) for path in template_paths}
+        dropped = 0
+        for entry in os.scandir(self.shared_dir):
+            if entry.name.endswith('.rgbx') and entry.name.split('-', 1)[0] in prefixes:
+                self._remove_shared(entry.path)
+                dropped += 1
+        return dropped
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'shared_hits': self.shared_hits,
+                    'templates': len(self._images), 'bytes': self._bytes}
+
+    def _private_copy(self, img):
+        # Mapped images are read-only; converting to RGB makes the drawable copy
+        return img.convert('RGB') if img.mode == 'RGBX' else img.copy()
+
+    def _map_shared(self, template_path, signature):
+        if not self.shared_dir:
+            return None
+        path = f"{self._shared_prefix(template_path)}-{signature[0]}-{signature[1]}.rgbx"
+        try:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(buffer) < SHARED_HEADER.size:
+            return None
+        magic, width, height = SHARED_HEADER.unpack_from(buffer)
+        if magic != SHARED_MAGIC or len(buffer) != SHARED_HEADER.size + width * height * 4:
+            return None
+        # The image keeps the mapping alive; no pixel data is copied
+        return Image.frombuffer('RGBX', (width, height), memoryview(buffer)[SHARED_HEADER.size:],
+                                'raw', 'RGBX', 0, 1)
+
+    def _shared_prefix(self, template_path):
+        name = hashlib.sha256(os.path.abspath(template_path).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.shared_dir, name)
+
+    def _prune_shared(self, keep, stale_prefix):
+        # Drop older versions of this template, then the oldest files while
+        # over budget. Workers still mapping a removed file keep their copy.
+        files = []
+        total = 0
+        for entry in os.scandir(self.shared_dir):
+            if not entry.name.endswith('.rgbx'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith(stale_prefix) and entry.path != keep:
+                self._remove_shared(entry.path)
+                continue
+            files.append((stat.st_mtime, entry.path, stat.st_size))
+            total += stat.st_size
+        for _, path, size in sorted(files):
+            if total <= self.max_shared_bytes:
+                break
+            if path != keep:
+                self._remove_shared(path)
+                total -= size
+
+    def _remove_shared(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _discard(self, template_path):
+        entry = self._images.pop(template_path, None)
+        if entry is not None:
+            self._bytes -= entry[1].width * entry[1].height * len(entry[1].mode)
+
+template_cache = TemplateCache()
+
+def template_identity(template_path):
+    stat = os.stat(template_path)
+    return [template_path, stat.st_mtime_ns, stat.st_size]
+
+def render_key(template, post, **params):
+    # Content address of a rendered ad: template identity, the text fields
+    # that end up on the image and the parameters used to draw them
+    payload = json.dumps([
+        RENDER_VERSION,
+        template,
+        post.job_title,
+        post.job_location,
+        post.job_salary,
+        params,
+    ], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class RenderCache:
+    # Final JPEG bytes in a bounded in-memory LRU in front of a size-capped
+    # <key>.jpg directory shared by all workers and rescanned periodically.
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES, disk_dir=RENDER_CACHE_DIR,
+                 max_disk_bytes=RENDER_DISK_CACHE_BYTES, scan_interval=RENDER_DISK_SCAN_INTERVAL):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.scan_interval = scan_interval
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_entries = None
+        self._scanned = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return data
+            self._load_disk_index()
+            # Try the file even when the index misses: another worker may have written it
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self._disk_path(key))
+            except FileNotFoundError:
+                # Never written, or evicted by another worker sharing the directory
+                if key in self._disk_entries:
+                    self._disk_bytes -= self._disk_entries.pop(key)
+                self.misses += 1
+                return None
+            if key not in self._disk_entries:
+                self._disk_entries[key] = len(data)
+                self._disk_bytes += len(data)
+            self._disk_entries.move_to_end(key)
+            self.disk_hits += 1
+            self._remember(key, data)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._remember(key, data)
+            self._load_disk_index()
+            if key in self._disk_entries or len(data) > self.max_disk_bytes:
+                return
+            try:
+                tmp_path = self._disk_path(key) + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self._disk_path(key))
+            except OSError as e:
+                print(f"Error writing render cache entry: {e}")
+                return
+            self._disk_entries[key] = len(data)
+            self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes or time.time() - self._scanned > self.scan_interval:
+                # Count what the other workers wrote before deciding what to evict
+                self._load_disk_index(rescan=True)
+            while self._disk_bytes > self.max_disk_bytes:
+                old_key, old_size = self._disk_entries.popitem(last=False)
+                self._disk_bytes -= old_size
+                try:
+                    os.remove(self._disk_path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'memory_bytes': self._bytes,
+                    'disk_bytes': self._disk_bytes}
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous)
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= len(old)
+
+    def _load_disk_index(self, rescan=False):
+        # Scan the directory, oldest first, to rebuild the LRU order
+        if self._disk_entries is not None and not rescan:
+            return
+        self._disk_entries = OrderedDict()
+        self._disk_bytes = 0
+        self._scanned = time.time()
+        os.makedirs(self.disk_dir, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.jpg'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another worker mid-scan
+                    continue
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self._disk_entries[key] = size
+            self._disk_bytes += size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.jpg')
+
+render_cache = RenderCache()
+
+@lru_cache(maxsize=4096)
+def measure_text(text, font_size, font_path=FONT_PATH):
+    # Width and height of the rendered block, cached per (text, size, font)
+    left, top, right, bottom = _measure_draw.multiline_textbbox(
+        (0, 0), text, font=load_font(font_size, font_path))
+    return right - left, bottom - top
+
+def fit_font(text, max_width, max_height, max_size, min_size=MIN_FONT_SIZE, font_path=FONT_PATH):
+    # Largest size whose text block fits the bounding box. Text extent grows
+    # almost linearly with font size, so one measurement at max_size gives a
+    # close estimate; hinting and rounding can leave it a point or two off, so
+    # the estimate is re-scaled until it fits and then nudged up while the next
+    # size still fits. That is usually three measurements whatever the length
+    # of the text. Falls back to min_size if nothing fits.
+    def fits(w, h):
+        return w <= max_width and h <= max_height
+
+    size = max_size
+    w, h = measure_text(text, size, font_path)
+    while not fits(w, h) and size > min_size:
+        scale = min(max_width / w if w > max_width else 1, max_height / h if h > max_height else 1)
+        size = max(min_size, min(size - 1, int(size * scale)))
+        w, h = measure_text(text, size, font_path)
+    while fits(w, h) and size < max_size:
+        bigger = measure_text(text, size + 1, font_path)
+        if not fits(*bigger):
+            break
+        size += 1
+        w, h = bigger
+    return load_font(size, font_path), w, h
+
+def warm_worker(template_paths=()):
+    # Load the font file and every fitting size, and decode the given
+    # templates, up front so the first render is not slow
+    try:
+        font_registry.warm()
+    except Exception as e:
+        print(f"Error warming fonts: {e}")
+    for template_path in template_paths:
+        try:
+            template_cache.get(template_path)
+        except Exception as e:
+            print(f"Error warming template {template_path}: {e}")
+
+def normalize_template(src_path, dest_path, max_side=TEMPLATE_MAX_SIDE, quality=TEMPLATE_QUALITY):
+    # Turns an emailed attachment into a template that is cheap to render from:
+    # a baseline RGB JPEG no larger than max_side on either side, upright, and
+    # without EXIF, ICC or other metadata. Raises if the file is not a JPEG
+    # Pillow can decode (including decompression bombs). dest_path is replaced
+    # atomically, so readers never see a partial file.
+    with Image.open(src_path) as src:
+        if src.format != 'JPEG':
+            raise ValueError(f"not a JPEG image ({src.format})")
+        # Let libjpeg scale by 1/2, 1/4 or 1/8 while decoding huge images
+        src.draft('RGB', (max_side, max_side))
+        img = ImageOps.exif_transpose(src).convert('RGB')
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    tmp_path = dest_path + '.tmp'
+    try:
+        img.save(tmp_path, format='JPEG', quality=quality, progressive=False,
+                 optimize=True, dpi=(300, 300))
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # Decode once for every render worker
+    template_cache.publish(dest_path, img)
+    return img.size
+
+def render_plain(post):
+    # Create a blank image
+    img = Image.new('RGB', (1080, 1080), color='white')
+    draw = ImageDraw.Draw(img)
+
+    # Define text and bounding box
+    text = f"{post.job_title}\n{post.job_location}\n{post.job_salary}"
+    max_width = 1000
+    max_height = 1000
+
+    # Find the largest font size (starting at 100) that fits within the bounding box
+    font, w, h = fit_font(text, max_width, max_height, max_size=100)
+
+    # Calculate position
+    x = (1080 - w) / 2
+    y = (1080 - h) / 2
+
+    # Draw text
+    draw.multiline_text((x, y), text, fill='black', font=font, align='center')
+
+    # Encode to JPEG bytes
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='JPEG', dpi=(300, 300))
+    return img_bytes.getvalue()
+
+def render_with_template(post, template_path):
+    # Copy of the cached, already decoded template image
+    img = template_cache.get(template_path)
+    draw = ImageDraw.Draw(img)
+
+    # Define text and bounding box
+    text = f"{post.job_title}\n{post.job_location}\n{post.job_salary}"
+    max_width = img.width - 100
+    max_height = img.height - 100
+
+    # Find the largest font size (starting at 50) that fits within the bounding box
+    font, w, h = fit_font(text, max_width, max_height, max_size=50)
+
+    # Calculate position
+    x = (img.width - w) / 2
+    y = (img.height - h) / 2
+
+    # Draw text
+    draw.multiline_text((x, y), text, fill='black', font=font, align='center')
+
+    # Encode to JPEG bytes
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='JPEG', dpi=(300, 300))
+    return img_bytes.getvalue()
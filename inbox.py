@@ -0,0 +1,352 @@
+import binascii
+import imaplib
+import json
+import os
+import re
+import select
+import ssl
+import threading
+import time
+from collections import namedtuple
+from email.header import decode_header, make_header
+from urllib.parse import unquote
+
+# IMAP watcher configuration
+IMAP_IDLE_RENEW = float(os.getenv('IMAP_IDLE_RENEW', 600))
+IMAP_POLL_INTERVAL = float(os.getenv('IMAP_POLL_INTERVAL', 300))
+IMAP_RECONNECT_MIN = float(os.getenv('IMAP_RECONNECT_MIN', 5))
+IMAP_RECONNECT_MAX = float(os.getenv('IMAP_RECONNECT_MAX', 300))
+
+# Incremental sync configuration
+IMAP_STATE_PATH = os.getenv('IMAP_STATE_PATH', 'imap_state.json')
+IMAP_SYNC_BATCH = int(os.getenv('IMAP_SYNC_BATCH', 25))
+IMAP_FETCH_CHUNK = int(os.getenv('IMAP_FETCH_CHUNK_KB', 1024)) * 1024
+
+# Anything up to whitespace, parentheses or a quote; [...] sections may contain spaces
+ATOM_PATTERN = re.compile(rb'(?:[^\s()"\[\]]|\[[^\]]*\])+')
+
+# One leaf of a message's BODYSTRUCTURE; section is the BODY[...] part number
+BodyPart = namedtuple('BodyPart', 'section content_type encoding size disposition filename')
+
+class InboxWatcher:
+    # Holds one authenticated IMAP connection open and calls
+    # process(mail, uidvalidity) with the inbox selected whenever the server
+    # reports new mail. IDLE is re-issued every idle_renew seconds, well
+    # inside the 29 minutes servers allow, and the inbox is processed after
+    # every IDLE cycle as a safety net. Servers without IDLE are polled every
+    # poll_interval seconds on the same connection. Connection failures
+    # reconnect with exponential backoff.
+    def __init__(self, process, host, port, username, password, idle_renew=IMAP_IDLE_RENEW,
+                 poll_interval=IMAP_POLL_INTERVAL, reconnect_min=IMAP_RECONNECT_MIN,
+                 reconnect_max=IMAP_RECONNECT_MAX):
+        self.process = process
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.idle_renew = idle_renew
+        self.poll_interval = poll_interval
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='inbox-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        backoff = self.reconnect_min
+        while not self._stopping.is_set():
+            mail = None
+            try:
+                mail = imaplib.IMAP4_SSL(self.host, self.port)
+                mail.login(self.username, self.password)
+                mail.select('inbox')
+                uidvalidity = int(mail.response('UIDVALIDITY')[1][0])
+                backoff = self.reconnect_min
+                self._watch(mail, uidvalidity)
+            except Exception as e:
+                print(f"Inbox watcher error, reconnecting in {backoff:.0f}s: {e}")
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, self.reconnect_max)
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+
+    def _watch(self, mail, uidvalidity):
+        supports_idle = 'IDLE' in mail.capabilities
+        if not supports_idle:
+            print("IMAP server does not support IDLE, polling instead.")
+        # Pick up anything that arrived while we were not connected
+        self.process(mail, uidvalidity)
+        while not self._stopping.is_set():
+            if supports_idle:
+                self._idle(mail)
+            elif self._stopping.wait(self.poll_interval):
+                return
+            self.process(mail, uidvalidity)
+
+    def _idle(self, mail):
+        # imaplib has no IDLE support before Python 3.14, so speak it directly
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+        # The server may send untagged responses before the continuation
+        new_mail = False
+        while True:
+            response = self._readline(mail)
+            if response.startswith(b'+'):
+                break
+            if not response.startswith(b'*'):
+                raise imaplib.IMAP4.error(f"IDLE rejected: {response!r}")
+            new_mail = new_mail or self._announces_mail(response)
+
+        deadline = time.monotonic() + self.idle_renew
+        while not new_mail and not self._stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Wake up at least once a second so stop() is honoured
+            if not self._buffered(mail):
+                ready, _, _ = select.select([mail.sock], [], [], min(remaining, 1))
+                if not ready:
+                    continue
+            new_mail = self._announces_mail(self._readline(mail))
+
+        mail.send(b'DONE\r\n')
+        while not self._readline(mail).startswith(tag):
+            pass
+
+    def _announces_mail(self, line):
+        return line.rstrip().endswith((b'EXISTS', b'RECENT'))
+
+    def _buffered(self, mail):
+        # Whether a response is already waiting, without blocking. Lines that
+        # imaplib's buffered reader has taken off the socket are invisible to
+        # select, so peek at the reader with the socket briefly non-blocking;
+        # for TLS this also covers bytes already decrypted.
+        timeout = mail.sock.gettimeout()
+        mail.sock.setblocking(False)
+        try:
+            return bool(mail.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            mail.sock.settimeout(timeout)
+
+    def _readline(self, mail):
+        line = mail.readline()
+        if not line or line.startswith(b'* BYE'):
+            raise imaplib.IMAP4.abort(f"Connection closed during IDLE: {line!r}")
+        return line
+
+class UIDSync:
+    # Incremental sync of the inbox by UID. The mailbox's UIDVALIDITY and the
+    # highest processed UID are checkpointed to a JSON file, so each sync asks
+    # the server only for newer matching messages and a backlog is worked
+    # through in checkpointed chunks of batch_size. If UIDVALIDITY changes,
+    # old UIDs are meaningless and the sync starts again from the beginning.
+    def __init__(self, path=IMAP_STATE_PATH, batch_size=IMAP_SYNC_BATCH):
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+
+    def pending(self, mail, uidvalidity, criteria):
+        # Yields ascending chunks of unprocessed UIDs matching criteria
+        last_uid = self.last_uid(uidvalidity)
+        status, data = mail.uid('SEARCH', None, f'(UID {last_uid + 1}:* {criteria})')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID SEARCH failed: {data!r}")
+        # "n:*" always matches the newest message, even when its UID is below n
+        uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+        for i in range(0, len(uids), self.batch_size):
+            yield uids[i:i + self.batch_size]
+
+    def fetch(self, mail, uids, items='(BODYSTRUCTURE)'):
+        # One pipelined UID FETCH for the whole chunk; yields (uid, {item: value})
+        for attributes in fetch_items(mail, ','.join(map(str, uids)), items):
+            if 'UID' in attributes:
+                yield int(attributes.pop('UID')), attributes
+
+    def last_uid(self, uidvalidity):
+        state = self._load()
+        if state.get('uidvalidity') != uidvalidity:
+            return 0
+        return state.get('last_uid', 0)
+
+    def checkpoint(self, uidvalidity, uid):
+        with self._lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'uidvalidity': uidvalidity, 'last_uid': uid}, f)
+            os.replace(tmp_path, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+def fetch_items(mail, uids, items):
+    # Runs UID FETCH and yields each FETCH response's attributes as a dict
+    status, data = mail.uid('FETCH', uids, items)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH failed: {data!r}")
+    # imaplib splits a response at every literal into (line, literal) tuples
+    # and closes it with the plain line that follows the last literal
+    response = b''
+    for entry in data:
+        if isinstance(entry, tuple):
+            response += entry[0] + b'\r\n' + entry[1]
+            continue
+        response += entry or b''
+        parsed = parse_response(response)
+        response = b''
+        if len(parsed) == 2 and isinstance(parsed[1], list):
+            pairs = parsed[1]
+            yield {key.decode('ascii').upper(): value
+                   for key, value in zip(pairs[::2], pairs[1::2])}
+
+def parse_response(data):
+    # Parses IMAP response data into nested lists of bytes; NIL becomes None
+    stack = [[]]
+    pos = 0
+    while pos < len(data):
+        c = data[pos:pos + 1]
+        if c in b' \r\n':
+            pos += 1
+        elif c == b'(':
+            stack.append([])
+            pos += 1
+        elif c == b')':
+            value = stack.pop()
+            stack[-1].append(value)
+            pos += 1
+        elif c == b'"':
+            value = bytearray()
+            pos += 1
+            while data[pos:pos + 1] != b'"':
+                if data[pos:pos + 1] == b'\\':
+                    pos += 1
+                value += data[pos:pos + 1]
+                pos += 1
+            stack[-1].append(bytes(value))
+            pos += 1
+        elif c == b'{':
+            end = data.index(b'}', pos)
+            start = data.index(b'\n', end) + 1
+            length = int(data[pos + 1:end])
+            stack[-1].append(data[start:start + length])
+            pos = start + length
+        else:
+            match = ATOM_PATTERN.match(data, pos)
+            atom = match.group()
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+            pos = match.end()
+    return stack[0]
+
+def body_parts(structure, section=''):
+    # Walks a parsed BODYSTRUCTURE and yields a BodyPart for every leaf
+    if isinstance(structure[0], list):
+        # Multipart: child bodies, then the subtype and extension data
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            yield from body_parts(child, f'{section}.{index}' if section else str(index))
+        return
+
+    section = section or '1'
+    maintype, subtype, params, _, _, encoding, size = structure[:7]
+    content_type = f'{maintype.decode()}/{subtype.decode()}'.lower()
+    extension = structure[7:]
+    if content_type == 'message/rfc822':
+        # Envelope, encapsulated body and line count precede the extension data
+        nested = extension[1]
+        yield from body_parts(nested, section if isinstance(nested[0], list) else section + '.1')
+        extension = extension[3:]
+    elif content_type.startswith('text/'):
+        extension = extension[1:]
+
+    disposition = extension[1] if len(extension) > 1 and extension[1] else None
+    filename = None
+    if disposition:
+        filename = _param(disposition[1], 'filename')
+    if filename is None:
+        filename = _param(params, 'name')
+    yield BodyPart(section, content_type, (encoding or b'7bit').decode().lower(), int(size),
+                   disposition[0].decode().lower() if disposition else None, filename)
+
+def _param(params, name):
+    # Looks up a BODYSTRUCTURE parameter, decoding RFC 2231 and RFC 2047 values
+    params = dict(zip(params[::2], params[1::2])) if params else {}
+    params = {key.decode().lower(): value for key, value in params.items()}
+    if name + '*' in params:
+        value = params[name + '*'].decode('ascii', 'replace')
+        if value.count("'") >= 2:
+            charset, _, value = value.split("'", 2)
+            return unquote(value, encoding=charset or 'us-ascii', errors='replace')
+        return unquote(value)
+    value = params.get(name)
+    if value is None:
+        return None
+    return str(make_header(decode_header(value.decode('utf-8', 'replace'))))
+
+def download_part(mail, uid, part, f, chunk_size=IMAP_FETCH_CHUNK):
+    # Streams one body part into f with partial BODY.PEEK[section]<offset.length>
+    # fetches, decoding the transfer encoding as it goes, so memory use stays
+    # at one chunk whatever the size of the part
+    decoder = _PartDecoder(f, part.encoding)
+    offset = 0
+    while offset < part.size:
+        items = f'(BODY.PEEK[{part.section}]<{offset}.{chunk_size}>)'
+        chunk = b''
+        for attributes in fetch_items(mail, str(uid), items):
+            for key, value in attributes.items():
+                if key.startswith('BODY[') and value:
+                    chunk = value
+        if not chunk:
+            break
+        decoder.write(chunk)
+        offset += len(chunk)
+    decoder.close()
+
+class _PartDecoder:
+    # Incremental Content-Transfer-Encoding decoder writing into a file
+    def __init__(self, f, encoding):
+        self.f = f
+        self.encoding = encoding
+        self._pending = b''
+
+    def write(self, data):
+        if self.encoding == 'base64':
+            data = self._pending + b''.join(data.split())
+            usable = len(data) - len(data) % 4
+            self._pending = data[usable:]
+            self.f.write(binascii.a2b_base64(data[:usable]))
+        elif self.encoding == 'quoted-printable':
+            # Soft line breaks and =XX escapes never span a line ending
+            data = self._pending + data
+            usable = data.rfind(b'\n') + 1
+            self._pending = data[usable:]
+            self.f.write(binascii.a2b_qp(data[:usable]))
+        else:
+            self.f.write(data)
+
+    def close(self):
+        if self._pending:
+            if self.encoding == 'base64':
+                self.f.write(binascii.a2b_base64(self._pending + b'=' * (-len(self._pending) % 4)))
+            else:
+                self.f.write(binascii.a2b_qp(self._pending))
+            self._pending = b''
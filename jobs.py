@@ -0,0 +1,296 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from database import Database
+
+# Background job configuration
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', 'jobs.db')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 3600))
+JOB_VISIBILITY_TIMEOUT = float(os.getenv('JOB_VISIBILITY_TIMEOUT', 300))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_BASE = float(os.getenv('JOB_RETRY_BASE', 10))
+JOB_RETRY_MAX = float(os.getenv('JOB_RETRY_MAX', 900))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    visible_at REAL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    timings TEXT NOT NULL DEFAULT '{}',
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_visible_at ON jobs (visible_at);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated);
+CREATE TABLE IF NOT EXISTS dead_jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    failed_at REAL NOT NULL
+);
+"""
+
+class Job:
+    # A submission moving through queued -> rendering -> sending -> done/failed.
+    # timings holds the seconds spent in each stage that has finished; every
+    # stage change is written back and extends the job's lease. A handler that
+    # passes the job on to something that finishes it later (the outbox)
+    # calls hand_off(); the job then keeps its status when the handler returns
+    # and is closed with JobQueue.finish_handed_off() or fail_handed_off(),
+    # which may come before the handler has returned.
+    def __init__(self, queue, job_id, status='queued', timings=None):
+        self.id = job_id
+        self.status = status
+        self.timings = timings or {}
+        self.handed_off = False
+        self._queue = queue
+        self._stage_started = time.monotonic()
+
+    def hand_off(self):
+        self.handed_off = True
+
+    def set_status(self, status):
+        self.finish_stage(status)
+        self._queue.update(self)
+
+    def finish_stage(self, status):
+        now = time.monotonic()
+        self.timings[self.status] = round(now - self._stage_started, 4)
+        self.status = status
+        self._stage_started = now
+
+class PermanentJobError(Exception):
+    # Raised by a handler when retrying cannot help; the job is dead-lettered at once
+    pass
+
+class JobQueue:
+    # Durable queue in a WAL-mode SQLite file. Claimed jobs stay invisible for
+    # visibility_timeout seconds; a worker that dies without finishing leaves
+    # the job to be claimed again, so delivery is at-least-once. Failed jobs
+    # are retried with exponential backoff and moved to dead_jobs after
+    # max_attempts, or straight away when the failure is permanent.
+    def __init__(self, path=JOB_DB_PATH, visibility_timeout=JOB_VISIBILITY_TIMEOUT,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_base=JOB_RETRY_BASE,
+                 retry_max=JOB_RETRY_MAX):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._db = Database(path, SCHEMA)
+
+    def enqueue(self, kind, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._db.connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, kind, payload, status, visible_at, created, updated) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), now, now, now))
+        return job_id
+
+    def claim(self):
+        # Returns (job, kind, payload) for the next visible job, or None
+        db = self._db.connect()
+        now = time.time()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id, kind, payload, timings, visible_at FROM jobs "
+                "WHERE visible_at <= ? ORDER BY visible_at LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts + 1, "
+                "visible_at = ?, updated = ? WHERE id = ?",
+                (now + self.visibility_timeout, now, row[0]))
+        job = Job(self, row[0], timings=json.loads(row[3]))
+        # Count the time spent waiting in the queue towards the 'queued' stage
+        job._stage_started -= now - row[4]
+        return job, row[1], json.loads(row[2])
+
+    def update(self, job):
+        now = time.time()
+        with self._db.connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, timings = ?, visible_at = ?, updated = ? WHERE id = ?",
+                (job.status, json.dumps(job.timings), now + self.visibility_timeout, now, job.id))
+
+    def complete(self, job):
+        if job.handed_off:
+            # Off the queue; the status and error are left to finish_handed_off()
+            # or fail_handed_off(), which may already have run
+            with self._db.connect() as db:
+                db.execute("UPDATE jobs SET visible_at = NULL WHERE id = ?", (job.id,))
+            return
+        job.finish_stage('done')
+        with self._db.connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'done', timings = ?, visible_at = NULL, "
+                "error = NULL, updated = ? WHERE id = ?",
+                (json.dumps(job.timings), time.time(), job.id))
+
+    def finish_handed_off(self, job_id):
+        self._close_handed_off(job_id, 'done', None)
+
+    def fail_handed_off(self, job_id, error):
+        self._close_handed_off(job_id, 'failed', error)
+
+    def _close_handed_off(self, job_id, status, error):
+        # The time since the hand-off counts towards the job's last stage
+        now = time.time()
+        db = self._db.connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT status, timings, updated, kind, payload, attempts, created FROM jobs "
+                "WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[0] in ('done', 'failed'):
+                return
+            stage, timings, updated, kind, payload, attempts, created = row
+            timings = json.loads(timings)
+            timings[stage] = round(timings.get(stage, 0) + now - updated, 4)
+            db.execute(
+                "UPDATE jobs SET status = ?, timings = ?, visible_at = NULL, error = ?, updated = ? "
+                "WHERE id = ?",
+                (status, json.dumps(timings), error, now, job_id))
+            if status == 'failed':
+                db.execute(
+                    "INSERT OR REPLACE INTO dead_jobs (id, kind, payload, attempts, error, created, failed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, payload, attempts, error, created, now))
+
+    def fail(self, job, error, permanent=False):
+        now = time.time()
+        db = self._db.connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT kind, payload, attempts, created FROM jobs WHERE id = ?", (job.id,)).fetchone()
+            if row is None:
+                return
+            kind, payload, attempts, created = row
+            if permanent or attempts >= self.max_attempts:
+                job.finish_stage('failed')
+                db.execute(
+                    "UPDATE jobs SET status = 'failed', timings = ?, visible_at = NULL, "
+                    "error = ?, updated = ? WHERE id = ?",
+                    (json.dumps(job.timings), error, now, job.id))
+                db.execute(
+                    "INSERT OR REPLACE INTO dead_jobs (id, kind, payload, attempts, error, created, failed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job.id, kind, payload, attempts, error, created, now))
+            else:
+                delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+                db.execute(
+                    "UPDATE jobs SET status = 'queued', visible_at = ?, error = ?, updated = ? WHERE id = ?",
+                    (now + delay, error, now, job.id))
+
+    def get(self, job_id):
+        row = self._db.connect().execute(
+            "SELECT id, status, attempts, created, updated, timings, error FROM jobs WHERE id = ?",
+            (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row[0],
+            'status': row[1],
+            'attempts': row[2],
+            'created': row[3],
+            'updated': row[4],
+            'timings': json.loads(row[5]),
+            'error': row[6],
+        }
+
+    def prune(self, retention=JOB_RETENTION_SECONDS):
+        # Drop finished jobs; dead-lettered copies stay in dead_jobs
+        with self._db.connect() as db:
+            db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                (time.time() - retention,))
+
+class JobRunner:
+    # Pool of threads draining the JobQueue. Handlers are registered per job
+    # kind and called as handler(job, **payload), along with the exception
+    # classes that mean the job can never succeed (a payload that no longer
+    # validates, a file that is gone). Those and PermanentJobError skip the
+    # retries and go straight to dead_jobs.
+    def __init__(self, queue, workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL):
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._permanent = {}
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def register(self, kind, handler, permanent=()):
+        self._handlers[kind] = handler
+        self._permanent[kind] = (PermanentJobError,) + tuple(permanent)
+
+    def submit(self, kind, **payload):
+        job_id = self.queue.enqueue(kind, payload)
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        return self.queue.get(job_id)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        last_prune = 0
+        while not self._stopping.is_set():
+            try:
+                claimed = self.queue.claim()
+            except sqlite3.Error as e:
+                print(f"Error claiming job: {e}")
+                claimed = None
+            if claimed is None:
+                if time.time() - last_prune > 60:
+                    last_prune = time.time()
+                    try:
+                        self.queue.prune()
+                    except sqlite3.Error as e:
+                        print(f"Error pruning jobs: {e}")
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            job, kind, payload = claimed
+            try:
+                self._handlers[kind](job, **payload)
+                self.queue.complete(job)
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                permanent = isinstance(e, self._permanent.get(kind, PermanentJobError))
+                try:
+                    self.queue.fail(job, str(e), permanent)
+                except sqlite3.Error as db_error:
+                    # The lease runs out and the job is claimed again
+                    print(f"Error recording failure of job {job.id}: {db_error}")
+
+job_queue = JobQueue()
+job_runner = JobRunner(job_queue)
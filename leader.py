@@ -0,0 +1,95 @@
+import fcntl
+import os
+import threading
+
+# Leader election configuration
+LEADER_LOCK_PATH = os.getenv('LEADER_LOCK_PATH', 'leader.lock')
+LEADER_RETRY_INTERVAL = float(os.getenv('LEADER_RETRY_INTERVAL', 5))
+
+class LeaderElection:
+    # Picks one process among the app's workers to run singleton background
+    # duties by holding an exclusive flock on lock_path. The kernel drops the
+    # lock as soon as the holder exits or crashes, and standbys retry every
+    # retry_interval seconds, so a new leader takes over within that bound.
+    # on_elected callbacks run once in the winning process, each with an
+    # optional on_resign callback that undoes it; when the leader stops, the
+    # on_resign callbacks of the duties that started run in reverse order.
+    # A callback that raises is reported and skipped, so one failing duty
+    # does not keep the others from running.
+    def __init__(self, path=LEADER_LOCK_PATH, retry_interval=LEADER_RETRY_INTERVAL):
+        self.path = path
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self._duties = []
+        self._started = []
+        self._file = None
+        self._stopping = threading.Event()
+        self._thread = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def on_elected(self, callback, on_resign=None):
+        self._duties.append((callback, on_resign))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='leader-election', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.is_leader:
+            for callback in reversed(self._started):
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Error resigning leadership: {e}")
+            self._started = []
+            self.is_leader = False
+            # Unlock before closing so a standby can take over straight away
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if self._try_acquire():
+                print(f"Process {os.getpid()} elected leader.")
+                self.is_leader = True
+                for callback, on_resign in self._duties:
+                    try:
+                        callback()
+                    except Exception as e:
+                        print(f"Error starting leader duty {getattr(callback, '__name__', callback)}: {e}")
+                        continue
+                    if on_resign is not None:
+                        self._started.append(on_resign)
+                return
+            self._stopping.wait(self.retry_interval)
+
+    def _try_acquire(self):
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        # Record the holder for anyone inspecting the lock file
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._file = f
+        return True
+
+    def _after_fork(self):
+        # Forked children (render workers, pre-loaded app servers) share the
+        # parent's lock; closing their copy leaves it with the parent, and
+        # they take no part in the election
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.is_leader = False
+        self._started = []
+        self._thread = None
+        self._stopping = threading.Event()
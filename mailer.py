@@ -0,0 +1,600 @@
+import email
+import email.policy
+import email.utils
+import fcntl
+import heapq
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# SMTP configuration
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.office365.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 4))
+SMTP_MAX_SESSION_AGE = float(os.getenv('SMTP_MAX_SESSION_AGE', 600))
+SMTP_MAX_SESSION_MESSAGES = int(os.getenv('SMTP_MAX_SESSION_MESSAGES', 100))
+SMTP_IDLE_PROBE = float(os.getenv('SMTP_IDLE_PROBE', 30))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', 30))
+
+# Outbox configuration
+OUTBOX_SIZE = int(os.getenv('OUTBOX_SIZE', 1000))
+OUTBOX_SPILL_DIR = os.getenv('OUTBOX_SPILL_DIR', 'outbox')
+OUTBOX_SENDERS = int(os.getenv('OUTBOX_SENDERS', 1))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 20))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 6))
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', 30))
+
+# Delivery rate configuration. Exchange Online allows 30 messages a minute per
+# mailbox; OUTBOX_MAILBOX_RATES overrides it per sender, e.g. "a@x.com=60,b@x.com=10"
+OUTBOX_RATE_PER_MINUTE = float(os.getenv('OUTBOX_RATE_PER_MINUTE', 30))
+OUTBOX_MAILBOX_RATES = os.getenv('OUTBOX_MAILBOX_RATES', '')
+OUTBOX_BURST = float(os.getenv('OUTBOX_BURST', 5))
+OUTBOX_THROTTLE_PAUSE = float(os.getenv('OUTBOX_THROTTLE_PAUSE', 60))
+
+# Reply text Exchange Online and other servers use when throttling a sender
+THROTTLE_MARKERS = ('throttl', 'rate limit', 'ratelimit', 'too many', 'limit exceeded',
+                    'quotaexceeded', 'thread limit', 'try again later')
+
+class _SMTP(smtplib.SMTP):
+    # smtplib's starttls() has no way to offer a previous TLS session, so this
+    # repeats it with session= passed through to allow resumption.
+    def starttls(self, context=None, session=None):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, resp = self.docmd('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, resp)
+        self.sock = context.wrap_socket(self.sock, server_hostname=self._host, session=session)
+        self.file = None
+        self.helo_resp = None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return code, resp
+
+class _Session:
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.messages = 0
+
+class SMTPPool:
+    # Keeps up to `size` authenticated SMTP sessions open between sends.
+    # Sessions idle for longer than idle_probe are checked with NOOP before
+    # reuse, and are retired after max_age seconds or max_messages messages.
+    # One SSLContext is shared so new connections can resume the TLS session.
+    def __init__(self, username, password, host=SMTP_HOST, port=SMTP_PORT, starttls=True,
+                 size=SMTP_POOL_SIZE, max_age=SMTP_MAX_SESSION_AGE,
+                 max_messages=SMTP_MAX_SESSION_MESSAGES, idle_probe=SMTP_IDLE_PROBE,
+                 timeout=SMTP_TIMEOUT):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.idle_probe = idle_probe
+        self.timeout = timeout
+        self.connects = 0
+        self.reuses = 0
+        self._ssl_context = ssl.create_default_context()
+        self._tls_session = None
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        # A session can be dropped by the server between the probe and the
+        # send, so a failure on a reused session is retried once on a new one
+        for attempt in range(2):
+            try:
+                with self.connection(fresh=attempt > 0) as smtp:
+                    return smtp.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                if attempt:
+                    raise
+                print(f"SMTP session lost, reconnecting: {e}")
+
+    @contextmanager
+    def connection(self, fresh=False):
+        self._slots.acquire()
+        session = None
+        try:
+            session = None if fresh else self._checkout()
+            if session is None:
+                session = self._connect()
+            try:
+                yield session.smtp
+            except smtplib.SMTPServerDisconnected:
+                raise
+            except smtplib.SMTPException as e:
+                # The server answered with an error; the session itself is still
+                # usable unless smtplib closed it or the server is shutting it down
+                if session.smtp.sock is None or getattr(e, 'smtp_code', None) == 421:
+                    raise
+                session.last_used = time.monotonic()
+                self._checkin(session)
+                session = None
+                raise
+            session.messages += 1
+            session.last_used = time.monotonic()
+            self._checkin(session)
+        except BaseException:
+            if session is not None:
+                self._close(session)
+            raise
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            self._close(session)
+
+    def stats(self):
+        with self._lock:
+            return {'connects': self.connects, 'reuses': self.reuses, 'idle': len(self._idle)}
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                session = self._idle.pop()
+            now = time.monotonic()
+            if now - session.created > self.max_age or session.messages >= self.max_messages:
+                self._close(session)
+                continue
+            if now - session.last_used > self.idle_probe:
+                try:
+                    code, _ = session.smtp.noop()
+                except (smtplib.SMTPException, OSError):
+                    code = None
+                if code != 250:
+                    self._close(session)
+                    continue
+            with self._lock:
+                self.reuses += 1
+            return session
+
+    def _checkin(self, session):
+        if time.monotonic() - session.created > self.max_age or session.messages >= self.max_messages:
+            self._close(session)
+            return
+        with self._lock:
+            self._idle.append(session)
+
+    def _connect(self):
+        smtp = _SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls(context=self._ssl_context, session=self._tls_session)
+            smtp.login(self.username, self.password)
+            if self.starttls:
+                # TLS 1.3 tickets arrive after the handshake, so pick the session up after AUTH
+                self._tls_session = smtp.sock.session
+        except BaseException:
+            smtp.close()
+            raise
+        with self._lock:
+            self.connects += 1
+        return _Session(smtp)
+
+    def _close(self, session):
+        try:
+            session.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            session.smtp.close()
+
+def is_throttle_reply(code, resp):
+    if isinstance(resp, bytes):
+        resp = resp.decode('utf-8', 'replace')
+    text = str(resp).lower()
+    return code in (421, 432) or any(marker in text for marker in THROTTLE_MARKERS)
+
+def parse_mailbox_rates(spec):
+    rates = {}
+    for entry in spec.split(','):
+        if '=' in entry:
+            mailbox, rate = entry.split('=', 1)
+            rates[mailbox.strip().lower()] = float(rate)
+    return rates
+
+class TokenBucket:
+    # Allows `rate` messages a minute with bursts of up to `burst`. A throttle
+    # reply halves the rate and pauses sending; each success then adds back
+    # 5% of max_rate, so the rate settles just under what the server accepts.
+    def __init__(self, max_rate, burst=OUTBOX_BURST, pause=OUTBOX_THROTTLE_PAUSE):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.pause = pause
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def take(self):
+        # Consumes a token and returns 0, or returns the seconds to wait first
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) * 60 / self.rate
+
+    def throttled(self):
+        self.rate = max(self.max_rate / 32, self.rate / 2)
+        self._tokens = 0
+        self._paused_until = time.monotonic() + self.pause
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+class DeliveryScheduler:
+    # One token bucket per sending mailbox
+    def __init__(self, default_rate=OUTBOX_RATE_PER_MINUTE, rates=None):
+        self.default_rate = default_rate
+        self.rates = parse_mailbox_rates(OUTBOX_MAILBOX_RATES) if rates is None else rates
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, mailbox):
+        with self._lock:
+            return self._bucket(mailbox).take()
+
+    def throttled(self, mailbox):
+        with self._lock:
+            self._bucket(mailbox).throttled()
+
+    def succeeded(self, mailbox):
+        with self._lock:
+            self._bucket(mailbox).succeeded()
+
+    def stats(self):
+        with self._lock:
+            return {mailbox: round(bucket.rate, 2) for mailbox, bucket in self._buckets.items()}
+
+    def _bucket(self, mailbox):
+        bucket = self._buckets.get(mailbox)
+        if bucket is None:
+            bucket = self._buckets[mailbox] = TokenBucket(self.rates.get(mailbox, self.default_rate))
+        return bucket
+
+class _Outgoing:
+    def __init__(self, msg, spill_path):
+        self.msg = msg
+        self.mailbox = email.utils.parseaddr(msg['From'] or '')[1].lower()
+        self.spill_path = spill_path
+        # Spill files are named <time>-<random id>-<job id, if any>.eml[.<owner token>]
+        self.job_id = os.path.basename(spill_path).split('.eml')[0].split('-', 2)[2]
+        self.attempts = 0
+        self.enqueued = time.monotonic()
+
+    def __lt__(self, other):
+        return self.enqueued < other.enqueued
+
+class Outbox:
+    # Durable email queue: put() writes the message to spill_dir and returns;
+    # once start()ed, sender threads deliver it with per-mailbox pacing and
+    # retries, and report the outcome to on_delivered / on_failed.
+    def __init__(self, pool, size=OUTBOX_SIZE, spill_dir=OUTBOX_SPILL_DIR, senders=OUTBOX_SENDERS,
+                 batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 retry_base=OUTBOX_RETRY_BASE, scheduler=None, on_delivered=None, on_failed=None):
+        self.pool = pool
+        self.on_delivered = on_delivered
+        self.on_failed = on_failed
+        self.scheduler = scheduler or DeliveryScheduler()
+        self.spill_dir = spill_dir
+        self.senders = senders
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.spilled = 0
+        self._queue = queue.Queue(maxsize=size)
+        self._delayed = []
+        self._latencies = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._running = False
+        self._orphans_checked = 0
+        self._owner = None
+        self._owner_pid = None
+        self._owner_file = None
+
+    def put(self, msg, job_id=None):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        claimed = self._spill(msg, job_id)
+        with self._lock:
+            if self._running:
+                try:
+                    self._queue.put_nowait(_Outgoing(msg, claimed))
+                    return
+                except queue.Full:
+                    pass
+        self._unclaim(claimed)
+
+    def start(self):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._release_orphans()
+        self._stopping.clear()
+        self._threads = []
+        with self._lock:
+            self._running = True
+        for i in range(self.senders):
+            thread = threading.Thread(target=self._work, name=f'outbox-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        # Keep whatever was not delivered for the next process to send
+        with self._lock:
+            pending, self._delayed = [item for _, item in self._delayed], []
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in pending:
+            self._unclaim(item.spill_path)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            delayed = len(self._delayed)
+        spilled = sum(1 for name in os.listdir(self.spill_dir) if name.endswith('.eml')) \
+            if os.path.isdir(self.spill_dir) else 0
+        return {
+            'sending': self._running,
+            'queued': self._queue.qsize(),
+            'retrying': delayed,
+            'spilled': spilled,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'throttled': self.throttled,
+            'rates_per_minute': self.scheduler.stats(),
+            'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else None,
+        }
+
+    def _work(self):
+        batch = []
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                # Wait for the first send slot before taking a session from the pool
+                if not self._wait_for_token(batch[0]):
+                    break
+                with self.pool.connection() as smtp:
+                    while batch:
+                        throttled = not self._deliver(smtp, batch[0])
+                        batch.pop(0)
+                        if throttled:
+                            # Give the session back rather than hold it through the pause
+                            self._requeue(batch)
+                            batch = []
+                        elif batch and not self._wait_for_token(batch[0]):
+                            break
+            except Exception as e:
+                # Connection or login trouble: everything not yet sent in this batch is retried
+                print(f"Outbox SMTP error: {e}")
+                for item in batch:
+                    self._retry(item, str(e))
+                batch = []
+        # Stopping: hand anything still in hand back so close() can spill it
+        self._requeue(batch)
+
+    def _requeue(self, items):
+        now = time.monotonic()
+        with self._lock:
+            for item in items:
+                heapq.heappush(self._delayed, (now, item))
+
+    def _wait_for_token(self, item):
+        while True:
+            delay = self.scheduler.take(item.mailbox)
+            if not delay:
+                return True
+            if self._stopping.wait(delay):
+                return False
+
+    def _next_batch(self):
+        batch = self._due_retries()
+        if self._queue.empty():
+            self._load_spilled()
+        try:
+            if not batch:
+                batch.append(self._queue.get(timeout=1))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _deliver(self, smtp, item):
+        try:
+            smtp.send_message(item.msg)
+        except smtplib.SMTPServerDisconnected:
+            raise
+        except smtplib.SMTPRecipientsRefused as e:
+            codes = [code for code, _ in e.recipients.values()]
+            if any(is_throttle_reply(code, resp) for code, resp in e.recipients.values()):
+                self._throttled(item, str(e))
+                return False
+            if all(400 <= code < 500 for code in codes):
+                self._retry(item, str(e))
+            else:
+                self._give_up(item, str(e))
+            return True
+        except smtplib.SMTPResponseException as e:
+            if is_throttle_reply(e.smtp_code, e.smtp_error):
+                self._throttled(item, str(e))
+                return False
+            if 400 <= e.smtp_code < 500:
+                self._retry(item, str(e))
+            else:
+                self._give_up(item, str(e))
+            return True
+        self.scheduler.succeeded(item.mailbox)
+        with self._lock:
+            self.sent += 1
+            self._latencies.append(round(time.monotonic() - item.enqueued, 4))
+        os.remove(item.spill_path)
+        self._report(self.on_delivered, item.job_id)
+        return True
+
+    def _retry(self, item, error):
+        item.attempts += 1
+        if item.attempts >= self.max_attempts:
+            self._give_up(item, error)
+            return
+        delay = self.retry_base * 2 ** (item.attempts - 1)
+        with self._lock:
+            self.retried += 1
+            heapq.heappush(self._delayed, (time.monotonic() + delay, item))
+
+    def _throttled(self, item, error):
+        # Not the message's fault: slow the mailbox down and send it again
+        # once the scheduler allows, without counting an attempt
+        print(f"Outbox throttled for {item.mailbox}: {error}")
+        self.scheduler.throttled(item.mailbox)
+        with self._lock:
+            self.throttled += 1
+            heapq.heappush(self._delayed, (time.monotonic(), item))
+
+    def _give_up(self, item, error):
+        print(f"Outbox giving up on '{item.msg['Subject']}' to {item.msg['To']}: {error}")
+        with self._lock:
+            self.failed += 1
+        os.replace(item.spill_path, item.spill_path + '.failed')
+        self._report(self.on_failed, item.job_id, error)
+
+    def _report(self, callback, job_id, *args):
+        if callback is None or not job_id:
+            return
+        try:
+            callback(job_id, *args)
+        except Exception as e:
+            print(f"Error reporting delivery of job {job_id}: {e}")
+
+    def _due_retries(self):
+        due = []
+        now = time.monotonic()
+        with self._lock:
+            while self._delayed and self._delayed[0][0] <= now and len(due) < self.batch_size:
+                due.append(heapq.heappop(self._delayed)[1])
+        return due
+
+    def _spill(self, msg, job_id=None):
+        # Written straight to its claimed name; returns that path
+        path = os.path.join(self.spill_dir, f"{time.time():.6f}-{uuid.uuid4().hex}-{job_id or ''}.eml")
+        claimed = f"{path}.{self._claim_token()}"
+        with open(claimed + '.tmp', 'wb') as f:
+            f.write(msg.as_bytes())
+        os.replace(claimed + '.tmp', claimed)
+        with self._lock:
+            self.spilled += 1
+        return claimed
+
+    def _load_spilled(self):
+        # Claim spilled files by renaming them with our token, so several
+        # processes sharing the directory never send the same file twice
+        if time.monotonic() - self._orphans_checked > 60:
+            self._release_orphans()
+        names = sorted(name for name in os.listdir(self.spill_dir) if name.endswith('.eml'))
+        for name in names[:self._queue.maxsize - self._queue.qsize()]:
+            path = os.path.join(self.spill_dir, name)
+            claimed = f"{path}.{self._claim_token()}"
+            try:
+                os.rename(path, claimed)
+                with open(claimed, 'rb') as f:
+                    msg = email.message_from_binary_file(f, policy=email.policy.default)
+                self._queue.put_nowait(_Outgoing(msg, spill_path=claimed))
+            except FileNotFoundError:
+                continue
+            except queue.Full:
+                self._unclaim(claimed)
+                break
+
+    def _unclaim(self, claimed):
+        os.replace(claimed, claimed.rsplit('.', 1)[0])
+
+    def _claim_token(self):
+        # Random per process run rather than the pid, which a restarted
+        # container hands out again. The owner holds an flock on
+        # <token>.owner for as long as it lives.
+        with self._lock:
+            if self._owner_pid != os.getpid():
+                token = uuid.uuid4().hex
+                path = os.path.join(self.spill_dir, f"{token}.owner")
+                f = open(path + '.tmp', 'w')
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # Locked before it appears, so nobody mistakes it for an orphan
+                os.replace(path + '.tmp', path)
+                self._owner, self._owner_pid, self._owner_file = token, os.getpid(), f
+            return self._owner
+
+    def _release_orphans(self):
+        # Files claimed by a process that no longer holds its owner lock go back in the queue
+        self._orphans_checked = time.monotonic()
+        alive = {self._claim_token(): True}
+        names = os.listdir(self.spill_dir)
+        for name in names:
+            base, _, token = name.rpartition('.')
+            if not base.endswith('.eml') or token in ('tmp', 'failed'):
+                continue
+            if token not in alive:
+                alive[token] = self._owner_alive(token)
+            if not alive[token]:
+                self._unclaim(os.path.join(self.spill_dir, name))
+        for name in names:
+            token, _, suffix = name.partition('.')
+            if suffix != 'owner':
+                continue
+            if token not in alive:
+                alive[token] = self._owner_alive(token)
+            if not alive[token]:
+                try:
+                    os.remove(os.path.join(self.spill_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def _owner_alive(self, token):
+        try:
+            f = open(os.path.join(self.spill_dir, f"{token}.owner"))
+        except FileNotFoundError:
+            return False
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
@@ -0,0 +1,60 @@
+from typing import Annotated
+
+import msgspec
+
+# Job post validation
+FIELD_MAX_LENGTH = 200
+NEW_BRAND = 'New Brand'
+
+Text = Annotated[str, msgspec.Meta(max_length=FIELD_MAX_LENGTH)]
+RequiredText = Annotated[str, msgspec.Meta(min_length=1, max_length=FIELD_MAX_LENGTH)]
+# A file name in the template directory, or NEW_BRAND; never a path
+TemplateName = Annotated[str, msgspec.Meta(max_length=FIELD_MAX_LENGTH, pattern=r'^(?!\.)[^/\\]*$')]
+
+class JobPost(msgspec.Struct, frozen=True):
+    # One job post, as submitted through the form or the webhook. Decoding
+    # validates every field in the same pass, so the renderers and mailers
+    # can rely on the attributes being present and bounded. Unknown fields
+    # are ignored.
+    email: RequiredText
+    job_title: RequiredText
+    job_location: RequiredText
+    job_salary: RequiredText
+    job_type: Text = ''
+    published_client: Text = ''
+    wants_branded_ad: bool = False
+    template_selection: TemplateName = ''
+
+    def __post_init__(self):
+        # Raised as msgspec.ValidationError by the decoders
+        if self.wants_branded_ad and not self.template_selection:
+            raise ValueError("A branded ad needs a template_selection")
+
+    @property
+    def new_brand(self):
+        return self.wants_branded_ad and self.template_selection == NEW_BRAND
+
+    def form_fields(self):
+        # The form's field values, for a link that opens the form pre-filled
+        fields = msgspec.structs.asdict(self)
+        fields['wants_branded_ad'] = 'yes' if self.wants_branded_ad else 'no'
+        return fields
+
+_json_decoder = msgspec.json.Decoder(JobPost)
+
+def decode_json(body):
+    # Raises msgspec.ValidationError or msgspec.DecodeError
+    return _json_decoder.decode(body)
+
+def from_form(form):
+    # The form sends wants_branded_ad as 'yes' or 'no'; raises msgspec.ValidationError
+    fields = form.to_dict()
+    fields['wants_branded_ad'] = fields.get('wants_branded_ad') == 'yes'
+    return msgspec.convert(fields, JobPost)
+
+def to_payload(post):
+    # Plain dict for the JSON job queue
+    return msgspec.to_builtins(post)
+
+def from_payload(payload):
+    return msgspec.convert(payload, JobPost)
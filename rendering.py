@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from imaging import font_stats, warm_worker
+
+# Render pool configuration. Every web worker starts its own pool, so by
+# default the cores are split between them; WEB_CONCURRENCY is the worker
+# count gunicorn reads from the environment.
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+RENDER_QUEUE_DEPTH = int(os.getenv('RENDER_QUEUE_DEPTH', RENDER_WORKERS * 4))
+RENDER_QUEUE_TIMEOUT = float(os.getenv('RENDER_QUEUE_TIMEOUT', 5))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', 30))
+
+# Incoming template normalization pool
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))
+
+# Workers are always forked: a spawned or forkserver child re-imports the
+# main module, and app.py starts threads and pools at import time
+_fork = multiprocessing.get_context('fork')
+
+class RenderQueueFull(Exception):
+    pass
+
+class RenderService:
+    # Runs Pillow work in a bounded process pool so request threads only wait
+    # on a future. At most queue_depth renders are running or waiting at once;
+    # beyond that submit() waits queue_timeout seconds and then gives up.
+    # With workers=0 renders run inline, which is handy for debugging.
+    # Counters kept inside the workers are invisible to the web process, so
+    # when worker_stats is given every task also returns its result, and
+    # stats() adds up the latest figures from each live worker.
+    def __init__(self, workers=RENDER_WORKERS, queue_depth=RENDER_QUEUE_DEPTH,
+                 queue_timeout=RENDER_QUEUE_TIMEOUT, initializer=warm_worker,
+                 worker_stats=font_stats):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.initializer = initializer
+        self.initargs = ()
+        self.worker_stats = worker_stats
+        self._worker_stats = {}
+        self._slots = threading.BoundedSemaphore(max(queue_depth, 1))
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise RenderQueueFull("Render queue is full")
+        try:
+            if self.worker_stats is not None:
+                fn, args = _call_and_report, (self.worker_stats, fn) + args
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # A worker died since the last submission; replace the pool
+                self._reset(executor)
+                future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        if self.worker_stats is not None:
+            future = self._unwrap(future)
+        return future
+
+    def render(self, fn, *args, timeout=RENDER_TIMEOUT):
+        if self.workers <= 0:
+            return fn(*args)
+        executor = self._get_executor()
+        try:
+            return self.submit(fn, *args).result(timeout)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool and retry once
+            self._reset(executor)
+            return self.submit(fn, *args).result(timeout)
+
+    def warm(self, *initargs):
+        # Starts every worker, passing initargs to the initializer, and returns
+        # futures that finish once each worker has run it
+        self.initargs = initargs
+        if self.workers <= 0:
+            if self.initializer is not None:
+                self.initializer(*initargs)
+            return []
+        executor = self._get_executor()
+        return [executor.submit(int) for _ in range(self.workers)]
+
+    def stats(self):
+        # Sum of the latest worker_stats() figures from each live worker
+        if self.worker_stats is None:
+            return {}
+        if self.workers <= 0:
+            return dict(self.worker_stats(), workers=1)
+        with self._lock:
+            reports = list(self._worker_stats.values())
+        totals = {'workers': len(reports)}
+        for report in reports:
+            for name, value in report.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _unwrap(self, inner):
+        # Future for the task's own result; records the stats that came with it
+        outer = Future()
+        def done(future):
+            if future.cancelled():
+                outer.cancel()
+                outer.set_running_or_notify_cancel()
+                return
+            try:
+                result, pid, stats = future.result()
+            except BaseException as e:
+                outer.set_exception(e)
+                return
+            with self._lock:
+                self._worker_stats[pid] = stats
+            outer.set_result(result)
+        inner.add_done_callback(done)
+        return outer
+
+    def _get_executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # A pool inherited across fork has no live workers or manager
+                # thread in this process; start a fresh one
+                self._executor = None
+                self._worker_stats = {}
+                self._pid = os.getpid()
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=self.initializer,
+                    initargs=self.initargs, mp_context=_fork)
+            return self._executor
+
+    def _reset(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+                self._worker_stats = {}
+        broken.shutdown(wait=False, cancel_futures=True)
+
+def _call_and_report(report, fn, *args):
+    # Runs in a worker: the task's result, the worker's pid and its stats
+    return fn(*args), os.getpid(), report()
+
+render_service = RenderService()
+# Separate pool so a backlog of incoming templates never delays renders;
+# submissions wait for a free slot instead of failing
+ingest_service = RenderService(workers=INGEST_WORKERS, queue_depth=INGEST_WORKERS * 2,
+                               queue_timeout=None, initializer=None, worker_stats=None)
@@ -0,0 +1,117 @@
+import os
+import secrets
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+from database import Database
+
+# Session store configuration
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+SESSION_EXPIRE_INTERVAL = float(os.getenv('SESSION_EXPIRE_INTERVAL', 300))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+"""
+
+class SessionStore:
+    # Server-side session data in a WAL-mode SQLite file, one row per session
+    # keyed by its random id. Reads and writes are single primary key
+    # lookups; expired rows are ignored on read and deleted in bulk by
+    # expire(), which walks the index on expires rather than every session.
+    def __init__(self, path=SESSION_DB_PATH):
+        self.path = path
+        self._db = Database(path, SCHEMA)
+
+    def load(self, sid):
+        # (data, expires), or None if the session is unknown or has expired
+        return self._db.connect().execute(
+            "SELECT data, expires FROM sessions WHERE id = ? AND expires > ?",
+            (sid, time.time())).fetchone()
+
+    def save(self, sid, data, expires):
+        with self._db.connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+                (sid, data, expires))
+
+    def delete(self, sid):
+        with self._db.connect() as db:
+            db.execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def expire(self):
+        with self._db.connect() as db:
+            return db.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+
+    def count(self):
+        return self._db.connect().execute(
+            "SELECT COUNT(*) FROM sessions WHERE expires > ?", (time.time(),)).fetchone()[0]
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires=0):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = sid is None
+        self.modified = False
+
+class SQLiteSessionInterface(SessionInterface):
+    # Flask session interface backed by a SessionStore. The cookie holds only
+    # the signed session id. A session is written back when it changes, or
+    # when less than half of its lifetime is left so active users stay signed
+    # in; other requests cost one indexed read and no write. Empty sessions
+    # are never stored, and clearing a session deletes its row.
+    serializer = TaggedJSONSerializer()
+    session_class = ServerSession
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        signer = Signer(app.secret_key, salt='session-id')
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = signer.unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            row = self.store.load(sid) if sid else None
+            if row is not None:
+                data, expires = row
+                return self.session_class(self.serializer.loads(data), sid, expires)
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        if not session.modified and session.expires - now > lifetime / 2:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        session.expires = now + lifetime
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), session.expires)
+        signer = Signer(app.secret_key, salt='session-id')
+        response.set_cookie(
+            name, signer.sign(session.sid).decode(),
+            max_age=int(lifetime), httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path, secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+session_store = SessionStore()
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+
+# Warm-up configuration
+PREWARM_TEMPLATES = int(os.getenv('PREWARM_TEMPLATES', 20))
+PREWARM_WINDOW_SECONDS = float(os.getenv('PREWARM_WINDOW_SECONDS', 7 * 24 * 3600))
+PREWARM_BUDGET = float(os.getenv('PREWARM_BUDGET', 30))
+
+class Warmup:
+    # Runs the registered warm-up steps in a background thread, once per
+    # process: start() is cheap to call on every request, and a process
+    # forked from one that already warmed up (e.g. a pre-loaded app server
+    # worker) starts its own warm-up on its first call. Each step is called
+    # with the seconds left of the budget. The process reports ready once
+    # every step has finished or the budget has run out, whichever is first.
+    def __init__(self, budget=PREWARM_BUDGET):
+        self.budget = budget
+        self._steps = []
+        self._pid = None
+        self._started = 0
+        self._finished = None
+        self._done = threading.Event()
+
+    def add(self, step):
+        self._steps.append(step)
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._started = time.monotonic()
+        self._finished = None
+        self._done = threading.Event()
+        threading.Thread(target=self._run, name='warmup', daemon=True).start()
+
+    def ready(self):
+        return self._done.is_set() or time.monotonic() - self._started >= self.budget
+
+    def status(self):
+        return {
+            'ready': self.ready(),
+            'finished': self._done.is_set(),
+            'seconds': round((self._finished or time.monotonic()) - self._started, 3),
+        }
+
+    def _run(self):
+        deadline = self._started + self.budget
+        for step in self._steps:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print("Warm-up budget exhausted; serving without it.")
+                break
+            try:
+                step(remaining)
+            except Exception as e:
+                print(f"Error during warm-up: {e}")
+        self._finished = time.monotonic()
+        self._done.set()
+
+warmup = Warmup()